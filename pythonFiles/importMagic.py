@@ -1,3 +1,4 @@
+import multiprocessing
 import os
 import sys
 
@@ -14,5 +15,14 @@ if __name__ == '__main__':
     if PY2:
         exit(101)
 
-    from src.daemon import ImportMagicDaemon
-    ImportMagicDaemon().watch()
+    # Writer processes of Whoosh use the default context. They shouldn't be
+    # forked from the daemon with its threads
+    multiprocessing.set_start_method('spawn')
+
+    if len(sys.argv) > 2 and sys.argv[1] == '--server':
+        # Shared by several workspaces: importMagic.py --server <socket>
+        from src.server import ImportMagicServer
+        ImportMagicServer(sys.argv[2]).serve_forever()
+    else:
+        from src.daemon import ImportMagicDaemon
+        ImportMagicDaemon().watch()
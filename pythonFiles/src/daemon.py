@@ -1,16 +1,50 @@
 import sys
 import io
 import json
+import os
+import threading
+import time
 import traceback
+from collections import deque
+from queue import Queue
 
 from src.extension import Extension
-from src.utils import pipeout
+from src.utils import pipeout, pipeout_frame
 from src import WarningException
 
 
 class ImportMagicDaemon(Extension):
-    def __init__(self):
-        self._input = io.open(sys.stdin.fileno(), encoding='utf-8')
+    # They change the index, so they are queued for the indexing thread.
+    # The other requests are served meanwhile from the last commit. The
+    # main thread queues them, so the ones sent during configure wait for it
+    _BACKGROUND_ACTIONS = ('changeFiles', 'rebuildIndex')
+
+    # A queued request is dropped when a newer one of the same action waits
+    # behind it. E.g. completion requests which are sent on each keystroke
+    _COALESCED_ACTIONS = ('getSymbols',)
+
+    # Requests which aren't profiled by the profile action
+    _UNPROFILED_ACTIONS = ('profile', 'stats')
+
+    # Seconds between progress messages. Only the last one is sent
+    PROGRESS_INTERVAL = 0.5
+
+    def __init__(self, input=None, output=None, errors=None):
+        self._input = input or io.open(sys.stdin.fileno(), encoding='utf-8')
+        self._output = output or sys.stdout
+        self._errors = errors or sys.stderr
+        self._output_lock = threading.Lock()
+        self._framed = False  # Output is switched after configure
+        self._progress = None  # The last message which wasn't sent
+        self._progress_timer = None
+        self._progress_time = 0
+        self._closed = False
+        self._tasks = Queue()
+        self._worker = threading.Thread(target=self._work, daemon=True)
+        self._pending = deque()  # Requests which wait for the main thread
+        self._pending_ready = threading.Condition()
+        self._reader = threading.Thread(target=self._read, daemon=True)
+        self._warmer = threading.Thread(target=self.warm_up, daemon=True)
         super().__init__()
 
     def _process_request(self, request):
@@ -18,37 +52,193 @@ class ImportMagicDaemon(Extension):
         cmd = Extension._COMMANDS.get(action)
         if not cmd:
             raise WarningException('Invalid action')
-        result = cmd(self, **request)
+
+        started = time.perf_counter()
+        error = True
+        try:
+            if action in self._UNPROFILED_ACTIONS:
+                result = cmd(self, **request)
+            else:
+                result = self._profiler.run(cmd, self, **request)
+            error = False
+        finally:
+            self._request_stats.add(
+                action, time.perf_counter() - started, error)
         return result if isinstance(result, dict) else dict(success=True)
 
+    def _write(self, stream, response):
+        # It's called with the output lock
+        if self._framed and stream is self._output:
+            pipeout_frame(stream, response)
+        else:
+            pipeout(stream, response)
+
     def _error_response(self, **response):
-        pipeout(sys.stderr, response)
+        with self._output_lock:
+            self._write_progress()
+            self._write(self._errors, response)
 
     def _success_response(self, **response):
-        pipeout(sys.stdout, response)
+        with self._output_lock:
+            # Progress goes before the response, e.g. before the end of
+            # indexing
+            self._write_progress()
+            self._write(self._output, response)
+            if 'protocol' in response:
+                # The configure response is the last one in lines
+                self._framed = self.framing == 'length'
 
-    def watch(self):
+    def notify_progress(self, text):
+        with self._output_lock:
+            self._progress = text
+            if self._progress_timer is not None:
+                return
+            delay = self._progress_time + self.PROGRESS_INTERVAL - \
+                time.time()
+            self._progress_timer = threading.Timer(
+                max(delay, 0), self._flush_progress)
+            self._progress_timer.daemon = True
+            self._progress_timer.start()
+
+    def _flush_progress(self):
+        with self._output_lock:
+            # The message could be sent before a response meanwhile
+            if self._progress_timer is threading.current_thread():
+                self._write_progress()
+
+    def _write_progress(self):
+        # It's called with the output lock
+        if self._progress_timer is not None:
+            self._progress_timer.cancel()
+            self._progress_timer = None
+        if self._progress is None:
+            return
+        text = self._progress
+        self._progress = None
+        self._progress_time = time.time()
+        self._write(self._output, dict(progress=text))
+
+    def _fatal_response(self, request_id):
+        exc_type, exc_value, exc_tb = sys.exc_info()
+        tb_info = traceback.extract_tb(exc_tb)
+        json_message = dict(
+            error=True, id=request_id, message=str(exc_value),
+            traceback=str(tb_info), type=str(exc_type))
+        self._error_response(**json_message)
+
+    def _cancelled_response(self, request_id):
+        self._success_response(id=request_id, cancelled=True)
+
+    def _run_in_background(self, func, *args):
+        self._tasks.put((None, func, args))
+
+    def _handle(self, request_id, func, *args):
+        # Returns False when daemon should be terminated
+        try:
+            response = func(*args)
+            if request_id:
+                json_message = dict(id=request_id, **response)
+                self._success_response(**json_message)
+        except WarningException as e:
+            # daemon will be work
+            json_message = dict(error=True, id=request_id, message=str(e))
+            self._error_response(**json_message)
+        except:
+            self._fatal_response(request_id)
+            return False
+        return True
+
+    def _exit(self):
+        # The other threads are blocked. Don't wait for them. A session of
+        # the server is closed instead, its threads return then
+        os._exit(102)
+
+    def _work(self):
         while True:
+            task = self._tasks.get()
+            if task is None:  # Closed
+                return
+            request_id, func, args = task
+            if not self._handle(request_id, func, *args):
+                self._exit()
+
+    def _read(self):
+        while not self._closed:
+            request_id = None
             try:
-                request = json.loads(self._input.readline())
+                line = self._input.readline()
+                if not line:  # The client has gone
+                    self._exit()
+                    return
+                request = json.loads(line)
                 request_id = request.get('requestId')
 
                 if not request_id:
                     raise ValueError('Empty request id')
-
-                response = self._process_request(request)
-                json_message = dict(id=request_id, **response)
-                self._success_response(**json_message)
-            except WarningException as e:
-                # daemon will be work
-                json_message = dict(error=True, id=request_id, message=str(e))
-                self._error_response(**json_message)
             except:
                 # daemon will be terminated
-                exc_type, exc_value, exc_tb = sys.exc_info()
-                tb_info = traceback.extract_tb(exc_tb)
-                json_message = dict(
-                    error=True, id=request_id, message=str(exc_value), 
-                    traceback=str(tb_info), type=str(exc_type))
-                self._error_response(**json_message)
-                exit(102)
+                self._fatal_response(request_id)
+                self._exit()
+                return
+
+            action = request.get('action')
+            if action == 'cancel':
+                self._cancel(request.get('cancelId'))
+                self._success_response(id=request_id, success=True)
+            else:
+                with self._pending_ready:
+                    self._pending.append(request)
+                    self._pending_ready.notify()
+
+    def _cancel(self, request_id):
+        # Only queued requests can be cancelled. Running ones are finished
+        with self._pending_ready:
+            for request in self._pending:
+                if request['requestId'] == request_id:
+                    self._pending.remove(request)
+                    break
+            else:
+                return
+        self._cancelled_response(request_id)
+
+    def _close(self):
+        # Stops the main loop. The worker stops after the tasks which were
+        # queued meanwhile, e.g. by configure
+        self._closed = True
+        with self._pending_ready:
+            self._pending_ready.notify()
+
+    def _next_request(self):
+        # Returns the request and whether it was superseded by a newer one.
+        # The request is None when it's closed
+        with self._pending_ready:
+            while not self._pending and not self._closed:
+                self._pending_ready.wait()
+            if self._closed:
+                return None, False
+            request = self._pending.popleft()
+            action = request.get('action')
+            superseded = action in self._COALESCED_ACTIONS and any(
+                r.get('action') == action for r in self._pending)
+        return request, superseded
+
+    def watch(self):
+        self._worker.start()
+        self._reader.start()
+        self._warmer.start()
+        while True:
+            request, superseded = self._next_request()
+            if request is None:
+                self._tasks.put(None)
+                return
+            request_id = request['requestId']
+            if superseded:
+                self._cancelled_response(request_id)
+            elif request.get('action') in self._BACKGROUND_ACTIONS:
+                # After the indexing tasks which configure has queued
+                self._tasks.put(
+                    (request_id, self._process_request, (request,)))
+            elif not self._handle(request_id, self._process_request,
+                                  request):
+                # Reader thread is waiting for input. Don't wait for it
+                self._exit()
@@ -0,0 +1,73 @@
+import sys
+import threading
+
+from src.index_manager import DB_VERSION, IndexManager
+from src.utils import md5_hash
+
+
+class Environment(object):
+    """
+    Index of the interpreter roots: builtins, stdlib and site-packages.
+    Workspaces which use the same interpreter have the same one, so a server
+    shares it between sessions. Project files are indexed apart
+    """
+    def __init__(self, extension, data_path, paths):
+        self.paths = paths
+        # It's changed only when packages are installed or removed
+        self.index_manager = IndexManager(extension, data_path, paths,
+                                          immutable=True)
+        self._claimed = False
+        self._claim_lock = threading.Lock()
+        self.failed = False  # A server creates it again then
+        # Sessions index it one at a time
+        self._write_lock = threading.Lock()
+        # Searcher and query cache are used by one thread at a time
+        self._search_lock = threading.Lock()
+
+    @staticmethod
+    def get_key(extension, paths):
+        # Sessions with the same key can share the index
+        return md5_hash('+'.join([
+            '+'.join(paths),
+            str(extension.skip_tests),
+            str(extension.content_hash),
+            str(sorted(extension.index_writer.items())),
+            extension.search_backend,
+            str(extension.fuzzy_matching),
+            sys.version,
+            str(DB_VERSION)
+        ]))
+
+    def claim(self):
+        # The first session opens the index or builds it
+        with self._claim_lock:
+            claimed = not self._claimed
+            self._claimed = True
+        return claimed
+
+    def run(self, func, *args):
+        with self._write_lock:
+            if self.failed:
+                # The next session builds it again
+                return None
+            try:
+                return func(*args)
+            except Exception:
+                self.failed = True
+                self.index_manager.cancel()
+                raise
+
+    def search(self, pattern, fuzzy=False, limit=50):
+        with self._search_lock:
+            return self.index_manager.search(pattern, fuzzy, limit)
+
+    def get_documents_count(self):
+        if not self.index_manager.is_opened():
+            return 0
+        return self.index_manager.get_documents_count()
+
+    def get_stats(self):
+        if not self.index_manager.is_opened():
+            return None
+        with self._search_lock:
+            return self.index_manager.get_index_stats()
@@ -1,5 +1,6 @@
 import os
 import locale
+from copy import deepcopy
 
 from difflib import unified_diff, SequenceMatcher
 
@@ -14,6 +15,57 @@ from isort import settings
 from isort.isort import _SortImports
 from isort.compat import get_settings_path, resolve, \
     determine_file_encoding, read_file_contents
+from src.utils import LRUCache
+
+# Files which isort looks for in the settings path and its parents
+CONFIG_FILES = ('.editorconfig', 'pyproject.toml', '.isort.cfg', 'setup.cfg',
+                'tox.ini')
+USER_CONFIG_FILES = ('~/.editorconfig', '~/.isort.cfg')
+MAX_CONFIG_SEARCH_DEPTH = 25
+
+_config_cache = LRUCache(16)
+
+
+def _get_config_fingerprint(settings_path):
+    # Config is parsed again when any of these files is changed or created
+    candidates = [os.path.expanduser(f) for f in USER_CONFIG_FILES]
+    # isort reads the user config dir too when appdirs is installed
+    appdirs = getattr(settings, 'appdirs', None)
+    if appdirs is not None:
+        candidates.append(appdirs.user_config_dir('isort.cfg'))
+    directory = str(settings_path)
+    for _ in range(MAX_CONFIG_SEARCH_DEPTH):
+        candidates.extend(os.path.join(directory, f) for f in CONFIG_FILES)
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            break
+        directory = parent
+
+    fingerprint = []
+    for candidate in candidates:
+        try:
+            fingerprint.append((candidate, os.stat(candidate).st_mtime))
+        except OSError:
+            pass
+    return tuple(fingerprint)
+
+
+def prepare_config(settings_path, **setting_overrides):
+    # Memoized settings.prepare_config(). Returns a copy for changes
+    key = (str(settings_path), tuple(sorted(setting_overrides.items())))
+    fingerprint = _get_config_fingerprint(settings_path)
+    entry = _config_cache.get(key)
+    if entry is None or entry[0] != fingerprint:
+        if entry is not None:
+            # Some isort versions memoize parsed files without invalidation
+            for func in (getattr(settings, 'from_path', None),
+                         getattr(settings, '_get_config_data', None)):
+                if hasattr(func, 'cache_clear'):
+                    func.cache_clear()
+        entry = (fingerprint, settings.prepare_config(
+            settings_path, **setting_overrides))
+        _config_cache.put(key, entry)
+    return deepcopy(entry[1])
 
 
 class SortImportsException(Exception):
@@ -31,7 +83,7 @@ class ExtendedSortImports(object):
         self._import_candidates.append('from %s import %s' % (from_, module_) \
             if module_ is not None else 'import %s' % from_)
 
-    def get_diff(self, **setting_overrides):
+    def get_diff(self, file_contents=None, **setting_overrides):
         # Follow code is a modified part of isort.compat.SortImports
         run_path=''
         check_skip=True
@@ -42,11 +94,11 @@ class ExtendedSortImports(object):
         file_path = Path(self._file_path)
         settings_path = None if self._settings_path is None else \
             Path(self._settings_path)
-        self.config = settings.prepare_config(
+        self.config = prepare_config(
             get_settings_path(settings_path, file_path), **setting_overrides)
         
         # Add custom import
-        self.config['add_imports'] = self.config['add_imports'] or []
+        self.config['add_imports'] = list(self.config['add_imports'] or [])
         for c in self._import_candidates:
             self.config['add_imports'].append(c)
 
@@ -65,17 +117,9 @@ class ExtendedSortImports(object):
                     "matches a glob in 'skip_glob' setting" % \
                     absolute_file_path)
     
-        preferred_encoding = determine_file_encoding(absolute_file_path)
-        fallback_encoding = locale.getpreferredencoding(False)
-        file_contents, used_encoding = read_file_contents(
-            absolute_file_path, encoding=preferred_encoding,
-            fallback_encoding=fallback_encoding)
-        if used_encoding is None:
-            raise SortImportsException(
-                "%s was skipped as it couldn't be opened with the given "
-                "%s encoding or %s fallback encoding" % (
-                    str(absolute_file_path), preferred_encoding,
-                    fallback_encoding))
+        if file_contents is None:
+            # Otherwise it's an unsaved editor buffer
+            file_contents = self._read_file_contents(absolute_file_path)
 
         if file_contents is None or ("isort:" + "skip_file") in file_contents:
             return []
@@ -89,16 +133,30 @@ class ExtendedSortImports(object):
         # END. compare file_contents vs self.output
         return self._show_diff(file_contents)
 
+    @staticmethod
+    def _read_file_contents(absolute_file_path):
+        preferred_encoding = determine_file_encoding(absolute_file_path)
+        fallback_encoding = locale.getpreferredencoding(False)
+        file_contents, used_encoding = read_file_contents(
+            absolute_file_path, encoding=preferred_encoding,
+            fallback_encoding=fallback_encoding)
+        if used_encoding is None:
+            raise SortImportsException(
+                "%s was skipped as it couldn't be opened with the given "
+                "%s encoding or %s fallback encoding" % (
+                    str(absolute_file_path), preferred_encoding,
+                    fallback_encoding))
+        return file_contents
+
     def _show_diff(self, file_contents):
         diff_commands = []
         s1 = file_contents.splitlines(1)
         s2 = self.output.splitlines(1)
-        if s2[-1].endswith('\n') and not s1[-1].endswith('\n'):
+        if s1 and s2 and s2[-1].endswith('\n') and not s1[-1].endswith('\n'):
             s1[-1] += '\n'
 
         # Parse our diff
-        matcher = SequenceMatcher(None, s1, s2)
-        for tag, i1, i2, j1, j2 in reversed(matcher.get_opcodes()):
+        for tag, i1, i2, j1, j2 in reversed(self._get_opcodes(s1, s2)):
             if tag == 'delete':
                 diff_commands.append({
                     'action': 'delete',
@@ -121,3 +179,36 @@ class ExtendedSortImports(object):
                     'text': ''.join(s2[j1:j2])
                 })
         return diff_commands
+
+    @staticmethod
+    def _get_opcodes(s1, s2):
+        # isort rewrites the import section and blank lines at the end. The
+        # rest is the same, so only changed regions are passed to matcher
+        n1, n2 = len(s1), len(s2)
+        while n1 and not s1[n1 - 1].strip():
+            n1 -= 1
+        while n2 and not s2[n2 - 1].strip():
+            n2 -= 1
+
+        start = 0
+        max_start = min(n1, n2)
+        while start < max_start and s1[start] == s2[start]:
+            start += 1
+        end = 0
+        max_end = max_start - start
+        while end < max_end and s1[n1 - end - 1] == s2[n2 - end - 1]:
+            end += 1
+
+        opcodes = []
+        matcher = SequenceMatcher(
+            None, s1[start:n1 - end], s2[start:n2 - end])
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag != 'equal':
+                opcodes.append(
+                    (tag, i1 + start, i2 + start, j1 + start, j2 + start))
+
+        if s1[n1:] != s2[n2:]:
+            tag = 'delete' if n2 == len(s2) else \
+                'insert' if n1 == len(s1) else 'replace'
+            opcodes.append((tag, n1, len(s1), n2, len(s2)))
+        return opcodes
@@ -1,14 +1,27 @@
 import os
+import tempfile
+import time
+from importlib import import_module
 
-import importmagic
-from isort.settings import WrapModes
 from src import WarningException
-from src.extended_isort import ExtendedSortImports
-from src.index_manager import IndexManager
-from src.indexer import DirIndexer, FileIndexer
+from src.stats import Profiler, RequestStats, get_memory_usage
+from src.utils import LRUCache, md5_hash
 
 
 class Extension(object):
+    SCOPE_CACHE_SIZE = 32  # Source buffers
+    SOURCE_CACHE_SIZE = 8  # Texts which can be referenced by sourceHash
+    MAX_RESULTS = 1000  # Search results which can be paged through
+
+    # Whoosh writer settings for rebuilding the index
+    INDEX_WRITER_DEFAULTS = dict(
+        procs=1, multisegment=False, limitmb=128, merge=True, optimize=False)
+
+    # They take most of the startup time, so commands import them when
+    # needed. warm_up() loads them while the first request is awaited
+    LAZY_MODULES = ('src.index_manager', 'src.environment', 'src.indexer',
+                    'src.parse_cache', 'src.extended_isort', 'importmagic')
+
     def __init__(self):
         self._inited = False
 
@@ -16,11 +29,32 @@ class Extension(object):
         self._style_max_columns = None
         self._style_indent_with_tabs = None
 
+        self._framing = 'lines'  # Of responses: 'lines' or 'length'
+        self._columnar_results = False  # Symbols are sent as columns
+
         self._workspace_path = None  # .isort.cfg could be placed there
         self._paths = []
         self._skip_tests = True
+        self._content_hash = False
+        self._index_workers = 1
+        self._index_writer = dict(self.INDEX_WRITER_DEFAULTS)
         self._temp_path = None
-        self._index_manager = None
+        self._cache_path = None
+        self._cache_size = 256  # Megabytes
+        self._search_backend = 'whoosh'
+        self._fuzzy_matching = False
+        self._skip_unchanged = True
+        self._index_manager = None  # Project files
+        self._environment = None  # Interpreter roots, can be shared
+        self._parse_cache = None
+
+        # Unresolved names by (source_file, content hash)
+        self._scope_cache = LRUCache(self.SCOPE_CACHE_SIZE)
+        self._source_cache = LRUCache(self.SOURCE_CACHE_SIZE)
+
+        self._request_stats = RequestStats()
+        self._indexing_stats = {}  # Last rebuild and update
+        self._profiler = Profiler()
 
     @property
     def style_multiline(self):
@@ -51,6 +85,23 @@ class Extension(object):
         if value is None or isinstance(value, bool):
             self._style_indent_with_tabs = value
 
+    @property
+    def framing(self):
+        return self._framing
+
+    @framing.setter
+    def framing(self, value):
+        if value in ('lines', 'length'):
+            self._framing = value
+
+    @property
+    def columnar_results(self):
+        return self._columnar_results
+
+    @columnar_results.setter
+    def columnar_results(self, value):
+        self._columnar_results = bool(value)
+
     @property
     def paths(self):
         return self._paths
@@ -77,6 +128,48 @@ class Extension(object):
     def skip_tests(self, value):
         self._skip_tests = bool(value)
 
+    @property
+    def content_hash(self):
+        return self._content_hash
+
+    @content_hash.setter
+    def content_hash(self, value):
+        self._content_hash = bool(value)
+
+    @property
+    def index_workers(self):
+        return self._index_workers
+
+    @index_workers.setter
+    def index_workers(self, value):
+        if isinstance(value, str) and value.isnumeric():
+            value = int(value)
+        if not isinstance(value, int) or value < 0:
+            return
+        # Zero means "use all cores"
+        self._index_workers = value or os.cpu_count() or 1
+
+    @property
+    def index_writer(self):
+        return self._index_writer
+
+    @index_writer.setter
+    def index_writer(self, value):
+        # Unknown options and invalid values are ignored
+        if not isinstance(value, dict):
+            value = {}
+        settings = dict(self.INDEX_WRITER_DEFAULTS)
+        for key, default in self.INDEX_WRITER_DEFAULTS.items():
+            item = value.get(key)
+            if type(item) is not type(default):
+                continue
+            if key == 'procs' and item < 0 or key == 'limitmb' and item < 1:
+                continue
+            settings[key] = item
+        # Zero means "use all cores"
+        settings['procs'] = settings['procs'] or os.cpu_count() or 1
+        self._index_writer = settings
+
     @property
     def temp_path(self):
         return self._temp_path
@@ -85,18 +178,81 @@ class Extension(object):
     def temp_path(self, value):
         self._temp_path = value
     
+    @property
+    def cache_path(self):
+        return self._cache_path
+
+    @cache_path.setter
+    def cache_path(self, value):
+        self._cache_path = value or os.path.join(
+            tempfile.gettempdir(), 'importmagic-cache')
+
+    @property
+    def cache_size(self):
+        return self._cache_size
+
+    @cache_size.setter
+    def cache_size(self, value):
+        if isinstance(value, str) and value.isnumeric():
+            value = int(value)
+        if isinstance(value, int) and value >= 0:
+            self._cache_size = value
+
+    @property
+    def search_backend(self):
+        return self._search_backend
+
+    @search_backend.setter
+    def search_backend(self, value):
+        if value in ('whoosh', 'memory'):
+            self._search_backend = value
+
+    @property
+    def fuzzy_matching(self):
+        return self._fuzzy_matching
+
+    @fuzzy_matching.setter
+    def fuzzy_matching(self, value):
+        self._fuzzy_matching = bool(value)
+
+    @property
+    def skip_unchanged(self):
+        return self._skip_unchanged
+
+    @skip_unchanged.setter
+    def skip_unchanged(self, value):
+        self._skip_unchanged = bool(value)
+
     def notify_progress(self, text):
         self._success_response(progress=text)
 
+    def _run_in_background(self, func, *args):
+        # Daemon runs it in the indexing thread
+        func(*args)
+
     def _cmd_configure(self, **kwargs):
         if self._inited:
             raise Exception('Restart to reconfigure it')
 
         self.paths = kwargs.get('paths', [])
         self.skip_tests = bool(kwargs.get('skipTest', True))
+        self.content_hash = kwargs.get('contentHash', False)
+        self.index_workers = kwargs.get('indexWorkers', 1)
+        self.index_writer = kwargs.get('indexWriter')
         self.temp_path = kwargs.get('tempPath')
+        self.cache_path = kwargs.get('cachePath')
+        self.cache_size = kwargs.get('cacheSize', 256)
+        self.search_backend = kwargs.get('searchBackend', 'whoosh')
+        self.fuzzy_matching = kwargs.get('fuzzyMatching', False)
+        self.skip_unchanged = kwargs.get('skipUnchanged', True)
         self.workspace_path = kwargs.get('workspacePath')
 
+        # Response format which the client understands
+        protocol = kwargs.get('protocol')
+        if isinstance(protocol, dict):
+            self.framing = protocol.get('framing')
+            self.columnar_results = protocol.get('columnar', False)
+
         style_settings = kwargs.get('style', {})
         self.style_multiline = style_settings.get('multiline')
         self.style_max_columns = style_settings.get('maxColumns')
@@ -108,71 +264,157 @@ class Extension(object):
         if not self.paths and os.path.exists(self.workspace_path):
             self.paths.append(self.workspace_path)
 
-        self._inited = True
+        from src.index_manager import DB_VERSION, IndexManager
+        from src.indexer import get_environment_paths
+        from src.parse_cache import ParseCache
+
+        if self.cache_size:
+            self._parse_cache = ParseCache(
+                self.cache_path, self.cache_size * 1024 * 1024, DB_VERSION)
+
         self.notify_progress('Index checking in progress...')
 
-        self._index_manager = IndexManager(
-            self, kwargs.get('workspaceName', 'default'))
+        data_path = os.path.join(
+            self.temp_path,
+            md5_hash(kwargs.get('workspaceName', 'default'))[:8])
+        self._environment = self._get_environment(
+            data_path, get_environment_paths(self.paths))
+        self._index_manager = IndexManager(self, data_path, self.paths,
+                                           base=self._environment)
+        self._inited = True
 
-        if not self._index_manager.open():
-            self._cmd_rebuild_index()
+        # Project files go first, the environment takes longer
+        self._open_index(self._index_manager)
+        if self._environment.claim():
+            self._open_index(self._environment.index_manager, builtins=True)
+
+        # The client switches to it after this response
+        return dict(success=True, protocol=dict(
+            framing=self.framing, columnar=self.columnar_results))
+
+    def _get_environment(self, data_path, paths):
+        # Server sessions share it
+        from src.environment import Environment
+        return Environment(self, data_path + '-environment', paths)
+
+    def _open_index(self, index_manager, builtins=False):
+        if not index_manager.open():
+            self._run_index_task(index_manager, self._rebuild_index,
+                                 index_manager, builtins)
+            return
+
+        # Searches are served from the snapshot until it's loaded
+        self._run_index_task(index_manager, index_manager.load_search_engine)
+
+        # Reindex only what was changed since the last run
+        changed_files = index_manager.get_changed_files()
+        if changed_files:
+            self._run_index_task(index_manager, self._update_index,
+                                 index_manager, changed_files)
+        if not index_manager.has_snapshot():
+            self._run_index_task(index_manager, index_manager.write_snapshot)
+
+    def _run_index_task(self, index_manager, func, *args):
+        # Sessions of a server change the environment one at a time
+        if index_manager is self._environment.index_manager:
+            self._run_in_background(self._environment.run, func, *args)
+        else:
+            self._run_in_background(func, *args)
+
+    def warm_up(self):
+        for name in self.LAZY_MODULES:
+            try:
+                import_module(name)
+            except ImportError:
+                # The command which needs it reports the error
+                pass
 
     def _report_scan_progress(self, value):
         self.notify_progress('Scan files... %i' % value)
 
+    def _get_indexing_stats(self, index_manager, indexer, started):
+        seconds = time.perf_counter() - started
+        files = len(indexer.indexed_files)
+        documents = index_manager.total_items
+        return dict(
+            files=files,
+            documents=documents,
+            seconds=round(seconds, 3),
+            files_per_s=round(files / seconds, 1) if seconds else 0,
+            documents_per_s=round(documents / seconds, 1) if seconds else 0,
+            phases=indexer.timer.get_stats())
+
     def _cmd_change_files(self, files, **kwargs):
         #pylint: disable=unused-argument
         if not self._inited:
             raise Exception('Run configure() at first')
 
-        # When __init__.py was changed we should rescan the all packages
-        # which placed under it. We will be use pathes as target prefixes
-        prefiexes = []
-        for f in list(files):
-            prefiexes.append(f)
-            basename = os.path.basename(f)
-            if basename == '__init__.py':
-                parts = f.split(os.path.sep)
-                if len(parts) > 1:
-                    package_path = os.path.sep.join(parts[:-1])
-                    prefiexes.append(package_path)
-
-        idx = FileIndexer(self.paths, prefiexes, self.skip_tests)
-        idx.build(self._report_scan_progress)
+        self._update_index(self._index_manager, files)
+        return dict(success=True, docs_count=self._get_documents_count())
 
-        self._index_manager.remove_from_index(idx)
+    def _update_index(self, index_manager, files):
+        from src.indexer import FileIndexer
 
-        self._index_manager.append_index(idx)
-        self._index_manager.commit(idx.total_files)
+        started = time.perf_counter()
+        # Files which weren't changed since the last commit are skipped
+        is_unchanged = index_manager.is_file_unchanged \
+            if self.skip_unchanged else None
+        idx = FileIndexer(index_manager.paths, files, self.skip_tests,
+                          self._parse_cache, is_unchanged)
+        idx.build(self._report_scan_progress)
+
+        index_manager.remove_from_index(idx)
 
-        all_docs_count = self._index_manager.get_documents_count()
-        return dict(success=True, docs_count=all_docs_count)
+        index_manager.append_index(idx)
+        index_manager.commit(idx)
+        self._indexing_stats[self._get_stats_key(index_manager, 'update')] = \
+            self._get_indexing_stats(index_manager, idx, started)
+        if index_manager.is_snapshot_outdated():
+            self._run_index_task(index_manager, index_manager.write_snapshot)
 
     def _cmd_rebuild_index(self, **kwargs):
         #pylint: disable=unused-argument
 
         if not self._inited:
             raise Exception('Run configure() at first')
+        self._rebuild_index(self._index_manager)
+        self._environment.run(self._rebuild_index,
+                              self._environment.index_manager, True)
+        return dict(success=True, docs_count=self._get_documents_count())
+
+    def _rebuild_index(self, index_manager, builtins=False):
         self.notify_progress('Rebuild index...')
-        
-        self._index_manager.recreate_index()
-        
-        idx = DirIndexer(self.paths, self.skip_tests)
-        idx.build(self._report_scan_progress)
-        total_items = idx.get_power() or 1
+        from src.indexer import DirIndexer
 
-        def report_listener2(value):
-            v = value * 100 / total_items
-            self.notify_progress('Indexing... %i%%' % int(v))
+        started = time.perf_counter()
+        index_manager.recreate_index()
 
-        self._index_manager.append_index(idx, report_listener2)
+        idx = DirIndexer(index_manager.paths, self.skip_tests,
+                         self.index_workers, self._parse_cache, builtins)
+        index_manager.build_index(idx, self._report_scan_progress)
         self.notify_progress('Save index file...')
-        self._index_manager.commit(idx.total_files)
-
-        all_docs_count = self._index_manager.get_documents_count()
-        return dict(success=True, docs_count=all_docs_count)
-
-    def _cmd_get_symbols(self, text, **kwargs):
+        index_manager.commit(idx)
+        self._indexing_stats[self._get_stats_key(index_manager, 'rebuild')] = \
+            self._get_indexing_stats(index_manager, idx, started)
+        if self.index_writer['optimize']:
+            # Searches use the new index while its segments are merged
+            self._run_index_task(index_manager, index_manager.optimize)
+        self._run_index_task(index_manager, index_manager.write_snapshot)
+
+    def _get_stats_key(self, index_manager, name):
+        if index_manager is self._environment.index_manager:
+            return 'environment_' + name
+        return name
+
+    def _get_documents_count(self):
+        return self._index_manager.get_documents_count() + \
+            self._environment.get_documents_count()
+
+    def _search(self, pattern, fuzzy=False, limit=50):
+        # The environment is searched by the project index too
+        return self._index_manager.search(pattern, fuzzy, limit)
+
+    def _cmd_get_symbols(self, text, limit=50, offset=0, **kwargs):
         #pylint: disable=unused-argument
         if not self._inited:
             raise Exception('Run configure() at first')
@@ -180,15 +422,39 @@ class Extension(object):
         if len(text) < 2:
             raise WarningException('You should find at least 2-symbols text')
 
-        results = []
-        for f in self._index_manager.search(text):
-            results.append(dict(
-                symbol=f['symbol'],
-                module=f['module'],
-                kind=f['kind']
-            ))
-
-        return dict(items=results)
+        self._check_page(limit, offset)
+        # One more is searched to know whether there are more
+        items = self._search(text, self.fuzzy_matching, offset + limit + 1)
+        return self._get_page(items, limit, offset)
+
+    def _check_page(self, limit, offset):
+        if not isinstance(limit, int) or not isinstance(offset, int) or \
+                limit < 1 or offset < 0:
+            raise WarningException('Invalid limit or offset')
+        if limit + offset > self.MAX_RESULTS:
+            raise WarningException(
+                'limit + offset should be at most %i' % self.MAX_RESULTS)
+
+    def _get_page(self, items, limit, offset):
+        result = self._encode_items(items[offset:offset + limit])
+        result['has_more'] = len(items) > offset + limit
+        return result
+
+    def _encode_items(self, items):
+        if not self.columnar_results:
+            return dict(items=[
+                dict(symbol=f['symbol'], module=f['module'], kind=f['kind'])
+                for f in items])
+
+        # Module names are repeated, every one is sent once
+        modules = {}
+        return dict(
+            columns=dict(
+                symbol=[f['symbol'] for f in items],
+                module=[modules.setdefault(f['module'], len(modules))
+                        for f in items],
+                kind=''.join(f['kind'] for f in items)),
+            modules=list(modules))
 
     def _cmd_insert_import(self, **kwargs):
         if not self._inited:
@@ -200,11 +466,25 @@ class Extension(object):
         if not source_file:
             raise WarningException('Empty sourceFile')
 
+        # Several imports can be added at once: [{module, symbol}, ...]
+        imports = kwargs.get('imports')
+        if imports is None:
+            imports = [dict(module=module, symbol=symbol)]
+        elif not isinstance(imports, list) or not all(
+                isinstance(i, dict) and i.get('symbol') for i in imports):
+            raise WarningException('Every import must have a symbol')
+
+        source_text = self._get_source_text(**kwargs)
+
+        from isort.settings import WrapModes
+        from src.extended_isort import ExtendedSortImports
+
         isort = ExtendedSortImports(source_file, self.workspace_path)
-        if not module:
-            isort.add_import(symbol)
-        else:
-            isort.add_import(module, symbol)
+        for item in imports:
+            if not item.get('module'):
+                isort.add_import(item['symbol'])
+            else:
+                isort.add_import(item['module'], item['symbol'])
 
         params = {'verbose': False}
         if self.style_max_columns is not None:
@@ -218,16 +498,38 @@ class Extension(object):
         if self.style_indent_with_tabs is not None:
             params['indent'] = '\t' if self.style_indent_with_tabs else ' '*4
 
-        diff = isort.get_diff(**params)
+        diff = isort.get_diff(source_text, **params)
         return dict(diff=diff)
         
 
-    def _cmd_import_suggestions(self, **kwargs):
+    def _cmd_import_suggestions(self, limit=50, offset=0, **kwargs):
         if not self._inited:
             raise Exception('Run configure() at first')
 
         source_file = kwargs.get('sourceFile')
         unresolved_name = kwargs.get('unresolvedName')
+        unresolved_names = kwargs.get('unresolvedNames')
+        self._check_page(limit, offset)
+
+        if unresolved_names is not None:
+            # Suggestions for several names in one request
+            if not isinstance(unresolved_names, list) or not all(
+                    isinstance(name, str) for name in unresolved_names):
+                raise WarningException('unresolvedNames must be a list of strings')
+            if not source_file:
+                raise WarningException('Empty sourceFile')
+
+            unresolved = self._get_unresolved_names(
+                source_file, self._get_source_text(**kwargs))
+            suggestions = {}
+            for name in unresolved_names:
+                if len(name) >= 2:
+                    result = self._get_suggestions(
+                        name, unresolved, limit, offset)
+                    # Plain results are lists like before
+                    suggestions[name] = result if self.columnar_results \
+                        else result['items']
+            return dict(suggestions=suggestions)
 
         if len(unresolved_name) < 2:
             raise WarningException('You should find at least 2-symbols text')
@@ -238,8 +540,36 @@ class Extension(object):
         if not unresolved_name:
             raise WarningException('Empty unresolvedName')
 
-        with open(source_file, 'r') as fd:
-            python_source = fd.read()
+        unresolved = self._get_unresolved_names(
+            source_file, self._get_source_text(**kwargs))
+        return self._get_suggestions(
+            unresolved_name, unresolved, limit, offset)
+
+    def _get_source_text(self, sourceText=None, sourceHash=None, **kwargs):
+        #pylint: disable=unused-argument
+        # Unsaved editor buffer. It can be referenced by hash later
+        if sourceText is not None:
+            self._source_cache.put(md5_hash(sourceText), sourceText)
+            return sourceText
+        if sourceHash is not None:
+            source_text = self._source_cache.get(sourceHash)
+            if source_text is None:
+                raise WarningException('Unknown sourceHash')
+            return source_text
+        return None
+
+    def _get_unresolved_names(self, source_file, python_source=None):
+        if python_source is None:
+            with open(source_file, 'r') as fd:
+                python_source = fd.read()
+
+        # Quick fixes of the same file are requested one by one
+        key = (source_file, md5_hash(python_source))
+        unresolved = self._scope_cache.get(key)
+        if unresolved is not None:
+            return unresolved
+
+        import importmagic
         scope = importmagic.Scope.from_source(python_source)
 
         _unresolved, _unreferenced = \
@@ -252,18 +582,46 @@ class Extension(object):
             for item2 in item1.split('.'):
                 unresolved.add(item2)
 
-        if unresolved_name not in unresolved:
-            return dict(items=[])
+        self._scope_cache.put(key, unresolved)
+        return unresolved
+
+    def _get_suggestions(self, unresolved_name, unresolved, limit, offset):
+        items = []
+        if unresolved_name in unresolved:
+            items = self._search(unresolved_name, limit=offset + limit + 1)
+        return self._get_page(items, limit, offset)
+
+    def _cmd_stats(self, **kwargs):
+        #pylint: disable=unused-argument
+        if not self._inited:
+            raise Exception('Run configure() at first')
+
+        return dict(
+            query_cache=self._index_manager.get_query_stats(),
+            requests=self._request_stats.get_stats(),
+            indexing=dict(self._indexing_stats),
+            index=self._index_manager.get_index_stats(),
+            environment=dict(
+                paths=self._environment.paths,
+                query_cache=self._environment.index_manager.get_query_stats(),
+                index=self._environment.get_stats()),
+            memory=get_memory_usage(),
+            profile=dict(remaining=self._profiler.remaining,
+                         files=self._profiler.files))
+
+    def _cmd_profile(self, requests=10, memory=False, **kwargs):
+        #pylint: disable=unused-argument
+        if not self._inited:
+            raise Exception('Run configure() at first')
 
-        results = []
-        for f in self._index_manager.search(unresolved_name):
-            results.append(dict(
-                symbol=f['symbol'],
-                module=f['module'],
-                kind=f['kind']
-            ))
+        if not isinstance(requests, int) or requests < 1:
+            raise WarningException('requests should be a positive number')
 
-        return dict(items=results)
+        # Files are written when the last of the requests is finished
+        file_path = os.path.join(
+            self.temp_path, 'profile-%s' % time.strftime('%Y%m%d-%H%M%S'))
+        self._profiler.start(file_path, requests, bool(memory))
+        return dict(success=True, path=file_path)
 
     _COMMANDS = {
         'configure': _cmd_configure,
@@ -271,5 +629,7 @@ class Extension(object):
         'rebuildIndex': _cmd_rebuild_index,
         'getSymbols': _cmd_get_symbols,
         'insertImport': _cmd_insert_import,
-        'importSuggestions': _cmd_import_suggestions
+        'importSuggestions': _cmd_import_suggestions,
+        'stats': _cmd_stats,
+        'profile': _cmd_profile
     }
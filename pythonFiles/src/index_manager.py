@@ -1,25 +1,76 @@
+import json
+import os
 import sys
 import time
 from os import makedirs, path
 
-from src.indexer import QuickIndexer
+from src.indexer import get_blacklist_re
+from src.manifest import Manifest, get_fingerprint
 from src.schema import IndexSchema
-from src.utils import md5_hash
+from src.snapshot import Snapshot, write_snapshot
+from src.stats import PhaseTimer
+from src.symbol_search import SymbolSearch, normalize
+from src.utils import LRUCache, md5_hash
 from whoosh import index
 from whoosh.qparser import QueryParser, plugins
+from whoosh.query import Or, Term
+from whoosh.writing import CLEAR, NO_MERGE
 
-DB_VERSION = 8
+DB_VERSION = 11
 
 
 class IndexManager(object):
-    def __init__(self, extension, workspace_name):
+    """
+    Index of the modules under paths. Indexes are tiered: the immutable
+    base of stdlib and third-party packages is changed only when packages
+    are installed. The project index is searched together with its base
+    """
+    QUERY_CACHE_SIZE = 256  # Patterns
+    QUERY_CANDIDATES = 1000  # Results which are kept for longer patterns
+    FUZZY_CANDIDATES = 50  # Ranked results which are kept at least
+    COMMIT_INTERVAL = 10  # Seconds between commits of a new index
+    SNAPSHOT_CHANGES_LIMIT = 10000  # Documents added after the snapshot
+
+    def __init__(self, extension, data_path, paths, base=None,
+                 immutable=False):
         self._extension = extension
-        self._workspace_hash_name = md5_hash(workspace_name)[:8]
+        self._data_path = data_path
+        self.paths = paths  # Roots of the indexed modules
+        self._base = base  # Searched too, has search() like this one
+        self._immutable = immutable  # Checked by the fingerprint of paths
         self._report_listener = None
         self._last_report_time = 0
         self._total_items = 0
+        self._timer = PhaseTimer()  # Of the current indexer
+        self._ix = None
         self._writer = None
 
+        # Reads are served from the last commit while the writer works
+        self._generation = 0  # Increments on every commit
+        self._searcher = None
+        self._searcher_generation = None
+
+        # Results by normalized pattern. Cleared when generation is changed
+        self._query_cache = LRUCache(self.QUERY_CACHE_SIZE)
+        self._query_cache_generation = None
+        self.query_hits = 0
+        self.query_misses = 0
+
+        # Alternative search backend. Changes are applied on commit
+        self._search_engine = None
+        self._search_engine_ready = False
+        if extension.search_backend == 'memory' or extension.fuzzy_matching:
+            self._search_engine = SymbolSearch(extension.fuzzy_matching)
+
+        # Mapped symbol table of the last rebuild and the changes after it
+        self._snapshot = None
+        self._added_documents = []
+        self._removed_files = set()
+        self._recreated = False
+        self._partial_commits = False
+        self._last_commit_time = 0
+        self._bulk_writing = False  # Rebuild writer settings are used
+
         # Create target temp path
         data_path = self._get_path()
         try:
@@ -27,8 +78,11 @@ class IndexManager(object):
         except OSError as e:
             pass
 
+        self._manifest = Manifest(path.join(data_path, '_manifest'),
+                                  use_hash=extension.content_hash)
+
     def _get_path(self):
-        return path.join(self._extension.temp_path, self._workspace_hash_name)
+        return self._data_path
 
     def _read_checksum(self):
         checksum = None
@@ -46,21 +100,20 @@ class IndexManager(object):
         except:
             pass
 
-    def _make_index_hashsum(self, total_files):
+    def _make_index_hashsum(self):
         return md5_hash('+'.join([
-            '+'.join(self._extension.paths),
+            '+'.join(self.paths),
             str(self._extension.skip_tests),
             sys.version,
-            str(DB_VERSION),
-            str(total_files)
+            str(DB_VERSION)
         ]))
 
     def open(self):
-        # Quickly count files in project (include system files)
-        idx = QuickIndexer(self._extension.paths, self._extension.skip_tests)
-        idx.build()
+        if self._read_checksum() != self._make_index_hashsum():
+            return
 
-        if self._read_checksum() != self._make_index_hashsum(idx.total_files):
+        # Without manifest we don't know what was changed
+        if not self._manifest.load():
             return
 
         # Trying to open
@@ -68,13 +121,140 @@ class IndexManager(object):
             self._open_index()
         except Exception:
             return
+
+        # In-memory search is loaded later. The snapshot serves meanwhile
+        self._snapshot = self._open_snapshot()
+        if self._snapshot is None:
+            self.load_search_engine()
         return True
 
+    def is_opened(self):
+        return self._ix is not None
+
+    def get_changed_files(self):
+        if self._immutable:
+            # Installed packages are the same, nothing to walk through
+            fingerprint = get_fingerprint(self.paths)
+            if fingerprint == self._manifest.fingerprint:
+                return []
+
+        # Compare the manifest with files on disk
+        changed_files = self._manifest.diff(
+            get_blacklist_re(self._extension.skip_tests))
+        if not changed_files:
+            if self._immutable:
+                self._manifest.update_fingerprint(fingerprint)
+            # Keep new directories mtime
+            self._manifest.save_if_dirty()
+        return changed_files
+
     def _open_index(self):
         self._ix = index.open_dir(self._get_path(), schema=IndexSchema)
     
     def recreate_index(self):
-        self._ix = index.create_in(self._get_path(), schema=IndexSchema)
+        # An opened index is cleared on commit. Until then readers get the
+        # old documents. A new one is searchable before it's complete
+        if self._ix is None:
+            self._ix = index.create_in(self._get_path(), schema=IndexSchema)
+            # Writer processes would be restarted on every commit
+            self._partial_commits = self._extension.index_writer['procs'] == 1
+            # The partial index shouldn't be opened after restart
+            self._write_checksum('')
+        self._recreated = True
+        self._bulk_writing = True
+
+    @staticmethod
+    def _iter_documents(reader):
+        if not reader.doc_count():  # A new index has no columns yet
+            return
+        sorts = reader.column_reader('sort')
+        for docnum, fields in reader.iter_docs():
+            yield dict(fields, sort=sorts[docnum])
+
+    def load_search_engine(self):
+        if self._search_engine is None or self._search_engine_ready:
+            return
+        if self._snapshot is not None:
+            self._search_engine.build(self._snapshot.iter_documents())
+        else:
+            with self._ix.reader() as reader:
+                self._search_engine.build(self._iter_documents(reader))
+        self._search_engine_ready = True
+        # Fuzzy results of the snapshot shouldn't be kept
+        self._query_cache_generation = None
+
+    def _get_snapshot_path(self):
+        return path.join(self._get_path(), '_snapshot')
+
+    def _open_snapshot(self):
+        # Changes after the snapshot are replayed from its journal. It's
+        # valid only if they lead to the current commit
+        snapshot = Snapshot.open(self._get_snapshot_path())
+        if snapshot is None:
+            return None
+        generation = snapshot.generation
+        try:
+            with open(self._get_snapshot_path() + '.journal', 'r') as f:
+                for line in f:
+                    entry = json.loads(line)
+                    snapshot.update(entry['removed'], entry['added'])
+                    generation = entry['generation']
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError):
+            return None
+        if generation != self._ix.latest_generation():
+            return None
+        return snapshot
+
+    def has_snapshot(self):
+        return self._snapshot is not None
+
+    def is_snapshot_outdated(self):
+        return self._snapshot is not None and \
+            self._snapshot.changes_count > self.SNAPSHOT_CHANGES_LIMIT
+
+    def write_snapshot(self):
+        # Runs in the indexing thread, so the index isn't changed meanwhile
+        snapshot_path = self._get_snapshot_path()
+        try:
+            with self._ix.reader() as reader:
+                write_snapshot(snapshot_path, self._iter_documents(reader),
+                               self._ix.latest_generation())
+            if path.exists(snapshot_path + '.journal'):
+                os.remove(snapshot_path + '.journal')
+        except OSError:
+            # E.g. Windows can't replace the mapped file
+            return
+        self._snapshot = Snapshot.open(snapshot_path)
+
+    def _remove_snapshot(self):
+        self._snapshot = None
+        for file_path in (self._get_snapshot_path(),
+                          self._get_snapshot_path() + '.journal'):
+            try:
+                os.remove(file_path)
+            except OSError:
+                pass
+
+    def _update_snapshot(self):
+        if self._recreated:
+            # It has the documents of the old index
+            self._remove_snapshot()
+            return
+        if self._snapshot is None:
+            return
+
+        self._snapshot.update(self._removed_files, self._added_documents)
+        entry = dict(generation=self._ix.latest_generation(),
+                     removed=sorted(self._removed_files),
+                     added=self._added_documents)
+        try:
+            with open(self._get_snapshot_path() + '.journal', 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+        except OSError:
+            # The snapshot won't be used after restart
+            pass
 
     def _add_document(self, filename, symbol, module, location, kind, 
                       score, **kwargs):
@@ -85,8 +265,22 @@ class IndexManager(object):
             location=location,
             kind=kind,
             sort=score)
-        
-        self.total_items += 1
+
+        # A rebuilt index is read back on commit instead, so the documents
+        # of the whole environment aren't kept meanwhile
+        if not self._recreated and (self._search_engine is not None or
+                                    self._snapshot is not None):
+            self._added_documents.append(dict(
+                filename=filename, symbol=symbol, module=module,
+                location=location, kind=kind, sort=score))
+
+        self._total_items += 1
+
+    def _add_documents(self, documents):
+        for document in documents:
+            self._add_document(**document)
+        # Progress is reported once per batch, not per document
+        self._report_progress()
 
     @property
     def total_items(self):
@@ -95,7 +289,9 @@ class IndexManager(object):
     @total_items.setter
     def total_items(self, value):
         self._total_items = value
-        
+        self._report_progress()
+
+    def _report_progress(self):
         ts = time.time()
         if ts - self._last_report_time > 0.3:
             self._last_report_time = ts
@@ -104,59 +300,260 @@ class IndexManager(object):
 
     def append_index(self, indexer, report_listener=None):
         self._report_listener = report_listener
+        self._timer = indexer.timer
         self.total_items = 0
 
         if not self._writer:
-            self._writer = self._ix.writer()
+            self._writer = self._create_writer()
 
         if indexer.target_prefixes is not None:
             # Add without empty filenames ''
-            def add_from_affected(filename, **kwargs):
-                if filename not in indexer.affected_files:
-                    return
-                self._add_document(filename=filename, **kwargs)
+            def add_from_affected(documents):
+                self._add_documents(
+                    document for document in documents
+                    if document['filename'] in indexer.affected_files)
             indexer.iterate(add_from_affected)
         else:
-            indexer.iterate(self._add_document)
+            indexer.iterate(self._add_documents)
 
         if self._report_listener:
             # Report about final count
             self._report_listener(self.total_items)
 
+    def build_index(self, indexer, report_listener=None):
+        # Documents are written while the indexer scans the modules, so the
+        # whole tree isn't kept in memory
+        self._report_listener = None
+        self._timer = indexer.timer
+        self.total_items = 0
+
+        if not self._writer:
+            self._writer = self._create_writer()
+        self._last_commit_time = time.time()
+
+        indexer.build(report_listener, self._add_streamed_documents)
+
+    def _create_writer(self):
+        settings = self._extension.index_writer
+        kwargs = dict(limitmb=settings['limitmb'])
+        if self._bulk_writing and settings['procs'] > 1:
+            # Documents of a rebuild are indexed by several processes
+            kwargs.update(procs=settings['procs'],
+                          multisegment=settings['multisegment'])
+        return self._ix.writer(**kwargs)
+
+    def _add_streamed_documents(self, documents):
+        self._add_documents(documents)
+        if self._partial_commits and \
+                time.time() - self._last_commit_time > self.COMMIT_INTERVAL:
+            self._commit_writer()
+            self._writer = self._create_writer()
+            self._last_commit_time = time.time()
+
     def remove_from_index(self, indexer):
+        self._timer = indexer.timer
         if not self._writer:
-            self._writer = self._ix.writer()
+            self._writer = self._create_writer()
 
-        del_count = 0
-        for filename in indexer.affected_files:
-            qp = QueryParser('filename', schema=self._ix.schema, plugins=[])
-            q = qp.parse(filename)
-            del_count += self._writer.delete_by_query(q)
-        return del_count
+        self._removed_files.update(indexer.affected_files)
 
-    def commit(self, total_files=None):
+        # Delete all of them in one pass
+        field = self._ix.schema['filename']
+        terms = [Term('filename', text)
+                 for filename in indexer.affected_files
+                 for text in field.process_text(filename)]
+        if not terms:
+            return 0
+        with self._timer.measure('write'):
+            return self._writer.delete_by_query(Or(terms))
+
+    def is_file_unchanged(self, filename):
+        return self._manifest.is_unchanged(filename)
+
+    def commit(self, indexer=None):
         if not self._writer:
             raise Exception('Writer is empty')
-        self._writer.commit()
+        self._commit_writer()
+        self._partial_commits = False
+        self._bulk_writing = False
+
+        if indexer is not None:
+            self._update_manifest(indexer)
+            self._write_checksum(self._make_index_hashsum())
+
+    def cancel(self):
+        # Drops the uncommitted changes and unlocks the index
+        if self._writer is not None:
+            self._writer.cancel()
+            self._writer = None
+        self._added_documents = []
+        self._removed_files = set()
+
+    def _commit_writer(self):
+        mergetype = None
+        if self._recreated:
+            mergetype = CLEAR
+        elif self._bulk_writing and not self._extension.index_writer['merge']:
+            # Segments of a rebuild are kept until optimize()
+            mergetype = NO_MERGE
+        with self._timer.measure('commit'):
+            self._writer.commit(mergetype=mergetype)
+            self._writer = None
+            self._update_snapshot()
+            self._update_search_engine()
+        self._generation += 1
+
+    def optimize(self):
+        # Merges all segments into one. Searches use the old ones meanwhile
+        self._writer = self._create_writer()
+        self._writer.commit(optimize=True)
         self._writer = None
+        self._update_snapshot()
+        self._generation += 1
+
+    def _update_search_engine(self):
+        if self._search_engine is not None:
+            if self._recreated:
+                # Searches use the old engine until the new one is ready
+                search_engine = SymbolSearch(self._search_engine.fuzzy)
+                with self._ix.reader() as reader:
+                    search_engine.build(self._iter_documents(reader))
+                self._search_engine = search_engine
+                self._search_engine_ready = True
+            else:
+                self._search_engine.remove(self._removed_files)
+                self._search_engine.add(self._added_documents)
+        self._added_documents = []
+        self._removed_files = set()
+        self._recreated = False
+
+    def _update_manifest(self, indexer):
+        if indexer.target_prefixes is None:
+            # Whole index was rebuilt
+            self._manifest.clear()
+            files = indexer.indexed_files
+        else:
+            # Removed files will be dropped from the manifest
+            files = indexer.affected_files
+
+        for filename in files:
+            self._manifest.update_file(filename)
+        for dirname in indexer.scanned_dirs:
+            self._manifest.update_dir(dirname)
+        if self._immutable:
+            self._manifest.update_fingerprint(get_fingerprint(self.paths))
+        self._manifest.save()
+
+    def search(self, pattern, fuzzy=False, limit=50):
+        items = self._search_cached(pattern, fuzzy, limit)
+        if self._base is None:
+            return items
+
+        # Fuzzy results are ordered by rank, the others by sort
+        items = items + self._base.search(pattern, fuzzy, limit)
+        items.sort(key=lambda item: item.get('rank', item.get('sort', 0)),
+                   reverse=True)
+        return items[:limit]
+
+    def _search_cached(self, pattern, fuzzy, limit):
+        if self._query_cache_generation != self._generation:
+            self._query_cache.clear()
+            self._query_cache_generation = self._generation
+
+        text = normalize(pattern)
+        items = self._get_cached_results(text, fuzzy, limit)
+        if items is None:
+            self.query_misses += 1
+            candidates = max(limit, self.FUZZY_CANDIDATES if fuzzy
+                             else self.QUERY_CANDIDATES)
+            items = self._search(text, fuzzy, candidates)
+            # Complete list has every match. Plain one can be filtered for
+            # the longer patterns
+            complete = len(items) < candidates
+            self._query_cache.put((text, fuzzy), (items, complete))
+        else:
+            self.query_hits += 1
+        return items[:limit]
+
+    def _get_cached_results(self, text, fuzzy, limit):
+        entry = self._query_cache.get((text, fuzzy))
+        if entry is not None:
+            items, complete = entry
+            if complete or len(items) >= limit:
+                return items
+        if fuzzy:
+            return None
+
+        # Symbols which contain the text contain its prefixes too
+        for size in range(len(text) - 1, 1, -1):
+            entry = self._query_cache.get((text[:size], False))
+            if entry is None or not entry[1]:
+                continue
+            items = [item for item in entry[0]
+                     if text in normalize(item['symbol'])]
+            self._query_cache.put((text, False), (items, True))
+            return items
+        return None
 
-        if total_files is not None:
-            self._write_checksum(self._make_index_hashsum(total_files))
+    def _search(self, text, fuzzy, limit):
+        if self._search_engine_ready:
+            # Fuzzy results are ranked, they can't be filtered later
+            return self._search_engine.search(text, limit, fuzzy)
 
-    def search(self, pattern):
+        snapshot = self._snapshot
+        if snapshot is not None:
+            return snapshot.search(text, limit)
+
+        items = []
+        searcher = self._get_searcher()
+        if searcher is None:
+            return items
         qp = QueryParser('symbol', schema=self._ix.schema, plugins=[
             plugins.WildcardPlugin()])
 
-        q = qp.parse('*%s*' % pattern)
-        items = []
-        with self._ix.searcher() as s:
-            results = s.search(q, limit=50, sortedby='sort', reverse=True)
-            for item in results:
-                items.append(item.fields())
+        q = qp.parse('*%s*' % text)
+        results = searcher.search(q, limit=limit, sortedby='sort',
+                                  reverse=True)
+        if results.is_empty():  # A new index has no columns yet
+            return items
+        # The score isn't stored, results of the tiers are merged by it
+        sorts = searcher.reader().column_reader('sort')
+        for item in results:
+            items.append(dict(item.fields(), sort=sorts[item.docnum]))
         return items
 
+    def get_query_stats(self):
+        total = self.query_hits + self.query_misses
+        return dict(
+            hits=self.query_hits,
+            misses=self.query_misses,
+            size=len(self._query_cache),
+            hit_rate=round(self.query_hits / total, 3) if total else 0)
+
+    def _get_searcher(self):
+        # Only the reading thread uses it. Reopen after every commit
+        if self._ix is None:
+            return None
+        if self._searcher_generation != self._generation:
+            if self._searcher is not None:
+                self._searcher.close()
+            self._searcher_generation = self._generation
+            self._searcher = self._ix.searcher()
+        return self._searcher
+
+    def get_index_stats(self):
+        if not self.is_opened():  # The first build is queued
+            return None
+        return dict(
+            documents=self._ix.doc_count(),
+            segments=len(self._ix._segments()),
+            generation=self._ix.latest_generation(),
+            snapshot=self._snapshot is not None,
+            search_engine=self._search_engine_ready)
+
     def get_documents_count(self):
-        return self._ix.searcher().doc_count()
+        with self._ix.searcher() as s:
+            return s.doc_count()
 
     def location_for(self, path):
         # Find 1st module mentioned in index and detect location name
@@ -1,93 +1,300 @@
+import multiprocessing
+import os
 import re
 import sys
 import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+
 import importmagic
-from src.symbol_index import ExtendedSymbolIndex
+from src.stats import PhaseTimer
+from src.symbol_index import ExtendedSymbolIndex, parse_module
+
+
+def get_blacklist_re(skip_tests=True):
+    if skip_tests:
+        return importmagic.index.DEFAULT_BLACKLIST_RE
+    return re.compile(r'^$')
+
+
+def get_environment_paths(project_paths):
+    # Roots of the interpreter: stdlib and site-packages. Project paths and
+    # this plugin are indexed apart
+    plugin_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    paths = []
+    for s in sys.path:
+        if not s or s in project_paths or s in paths:
+            continue
+        if 'vscode-importmagic' in s or \
+                os.path.abspath(s).startswith(plugin_path):
+            continue
+        paths.append(s)
+    return paths
+
+
+def create_executor(workers):
+    # Worker processes shouldn't be forked from the daemon with its threads
+    try:
+        return ProcessPoolExecutor(
+            workers, mp_context=multiprocessing.get_context('spawn'))
+    except TypeError:  # Python < 3.7
+        return ProcessPoolExecutor(workers)
 
 
 class Indexer(object):  # Manager for ExtendedSymbolIndex
-    def __init__(self, paths, skip_tests=True):
+    DEFERRED_BATCH = 512  # Modules which are parsed by workers at once
+    DOCUMENT_BATCH = 1000  # Documents which are passed to the listener
+
+    # Top-level modules which share their symbols with the others. They are
+    # emitted at the end of the build
+    ALIASED_MODULES = frozenset(
+        path.split('.')[0] for alias, (target, _) in
+        importmagic.SymbolIndex._PACKAGE_ALIASES.items()
+        for path in (alias, target))
+
+    def __init__(self, paths, skip_tests=True, workers=1, parse_cache=None,
+                 builtins=False):
         self.target_prefixes = None
         self.affected_files = set()  # Uses when target_prefixes was set
+        self.indexed_files = set()
+        self.scanned_dirs = set()
+        self.workers = workers
+        self.parse_cache = parse_cache
+        self.is_unchanged = None  # Files which can be skipped
+        self._deferred = None  # Modules which will be parsed by workers
+        self._executor = None
+        self._document_listener = None
+        self._documents = []  # Batch for the document listener
+        self._claimed_modules = set()  # Top-level names of the first root
         self._last_report_time = 0
         self._report_listener = None
-        self.total_files = 0
+        self._total_files = 0
+        self.timer = PhaseTimer()  # Walk, parse, scan, write and commit
 
-        if skip_tests:
-            self.blacklist_re = importmagic.index.DEFAULT_BLACKLIST_RE
-        else:
-            self.blacklist_re = re.compile(r'^$')
+        self.blacklist_re = get_blacklist_re(skip_tests)
+
+        # Roots are scanned in order, duplicates are dropped
+        self.paths = []
+        for path in paths:
+            if path and path not in self.paths:
+                self.paths.append(path)
+        self.builtins = builtins  # Index the compiled-in modules too
 
-        self.paths = list(set(paths + sys.path))
-        
-        # Remove this plugin pathes
-        for s in list(self.paths):
-            if 'vscode-importmagic' in s or s == '':
-                self.paths.remove(s)
-        
         self._index = ExtendedSymbolIndex(manager=self)
-        
+
+    @property
+    def total_files(self):
+        return self._total_files
+
+    @total_files.setter
+    def total_files(self, value):
+        self._total_files = value
+        self._report_progress(value)
+
+    def _report_progress(self, value):
         ts = time.time()
         if ts - self._last_report_time > 0.3:
             self._last_report_time = ts
             if self._report_listener:
-                self._report_listener(self.total_files)
+                self._report_listener(value)
 
-    def build(self, report_listener=None):
+    def build(self, report_listener=None, document_listener=None):
+        # With document_listener the documents of every complete top-level
+        # package are passed to it in lists and the package is dropped from
+        # the tree
         self._report_listener = report_listener
-        self._index.build_index()
+        self._document_listener = document_listener
+        with ExitStack() as stack:
+            stack.enter_context(self.timer.measure('walk'))
+            if self.workers > 1:
+                self._deferred = []
+                self._executor = stack.enter_context(
+                    create_executor(self.workers))
+            self._index.build_index()
+            self.flush(final=True)
+        self._deferred = None
+        self._executor = None
+        self._document_listener = None
+
+        if self.parse_cache is not None:
+            self.parse_cache.evict()
+
+    def defer_parsing(self, scope, module, subtree, filename, parse_cache):
+        if self._deferred is None:
+            return False
+        self._deferred.append((scope, module, subtree, filename, parse_cache))
+        return True
+
+    def is_claimed(self, name):
+        # The first module of the same name in paths is used, like Python does
+        return name in self._claimed_modules
+
+    def claim(self, name):
+        # Modules which wait for workers are claimed before they're emitted.
+        # Aliased ones are merged from every root until the end of the build
+        if name not in self.ALIASED_MODULES:
+            self._claimed_modules.add(name)
+
+    def flush(self, final=False):
+        # Called after every top-level path entry was scanned
+        if self._deferred:
+            if not final and len(self._deferred) < self.DEFERRED_BATCH:
+                return
+            self._parse_deferred()
+            self._deferred = []
+
+        if self._document_listener is None:
+            return
+        tree = self._index._tree
+        with self.timer.measure('scan'):
+            for key in list(tree):
+                if final or key not in self.ALIASED_MODULES:
+                    self._claimed_modules.add(key)
+                    self._scan_item(self._index, 1.0, key, tree.pop(key),
+                                    self._emit_document)
+            self._write_documents()
+
+    def _emit_document(self, **kwargs):
+        self._documents.append(kwargs)
+        if len(self._documents) >= self.DOCUMENT_BATCH:
+            self._write_documents()
+
+    def _write_documents(self):
+        if self._documents:
+            with self.timer.measure('write'):
+                self._document_listener(self._documents)
+            self._documents = []
+
+    def _parse_deferred(self):
+        filenames = [item[3] for item in self._deferred]
+        parse_caches = [item[4] for item in self._deferred]
+        chunksize = max(1, min(64, len(filenames) // (self.workers * 4)))
+        with self.timer.measure('parse'):
+            results = self._executor.map(
+                parse_module, filenames, parse_caches, chunksize=chunksize)
+            for item, result in zip(self._deferred, results):
+                scope, module, subtree = item[:3]
+                success, symbols = result
+                scope.apply_symbols(module, subtree, success, symbols)
     
     def get_power(self):
         return self._index.get_power()
     
     # def __iter__(self):  # Unfortually python 2 doesn't know "yield from"
     def iterate(self, callback):
-        return self._scan_tree(self._index, 1.0, callback)
+        # callback gets lists of documents
+        self._document_listener = callback
+        with self.timer.measure('scan'):
+            self._scan_tree(self._index, 1.0, self._emit_document)
+            self._write_documents()
+        self._document_listener = None
 
     def _scan_tree(self, scope, scale, callback):
         for key, subscope in scope._tree.items():
-            score = None
-            if type(subscope) is not float:
-                self._scan_tree(subscope, 
-                    subscope.score * scale - 0.1, callback)
-                score = subscope.score
-            else:
-                score = subscope
-
-            kind = 'T'  # Text
-            if score == 1.1 or score == 1.2:
-                kind = 'C'  # Class
-            if score == 0.25:
-                kind = 'R'  # Reference
-            if score == 1.2:
-                kind = 'F'  # Function
-            if score == 1:
-                kind = 'M'  # Module;
-
-            if '.' in key:
-                # Sometimes references from the others modules or bad-named 
-                # modules (for example "core.tmp" with __init__.py inside)
-                # can be there. We should skip it
-                continue
-            
-            callback(symbol=key, depth=scope.depth(),
-                filename=scope.filename or '', module=scope.path(),
-                location=scope.location, score=int(score * scale * 1000),
-                kind=kind)
+            self._scan_item(scope, scale, key, subscope, callback)
+
+    def _scan_item(self, scope, scale, key, subscope, callback):
+        score = None
+        if type(subscope) is not float:
+            self._scan_tree(subscope, 
+                subscope.score * scale - 0.1, callback)
+            score = subscope.score
+        else:
+            score = subscope
+
+        kind = 'T'  # Text
+        if score == 1.1 or score == 1.2:
+            kind = 'C'  # Class
+        if score == 0.25:
+            kind = 'R'  # Reference
+        if score == 1.2:
+            kind = 'F'  # Function
+        if score == 1:
+            kind = 'M'  # Module;
+
+        if '.' in key:
+            # Sometimes references from the others modules or bad-named 
+            # modules (for example "core.tmp" with __init__.py inside)
+            # can be there. We should skip it
+            return
+        
+        # Entry of a module belongs to its own file, so it's added and
+        # removed together with the module
+        filename = scope.filename
+        if type(subscope) is not float and subscope.filename:
+            filename = subscope.filename
+
+        callback(symbol=key, depth=scope.depth(),
+            filename=filename or '', module=scope.path(),
+            location=scope.location, score=int(score * scale * 1000),
+            kind=kind)
 
 
 class DirIndexer(Indexer):
-    def __init__(self, paths, skip_tests=True):
-        super().__init__(paths, skip_tests)
+    def __init__(self, paths, skip_tests=True, workers=1, parse_cache=None,
+                 builtins=False):
+        super().__init__(paths, skip_tests, workers, parse_cache, builtins)
 
 
 class FileIndexer(Indexer):
-    def __init__(self, paths, prefixes, skip_tests=True):
-        super().__init__(paths, skip_tests)
-        self.target_prefixes = prefixes
-
+    """
+    Reindexes only the given files. Module names are resolved from the
+    roots in paths, so the other packages aren't walked
+    """
+    def __init__(self, paths, files, skip_tests=True, parse_cache=None,
+                 is_unchanged=None):
+        super().__init__(paths, skip_tests, parse_cache=parse_cache)
+        self.files = files
+        self.is_unchanged = is_unchanged
 
-class QuickIndexer(Indexer):
-    def __init__(self, paths, skip_tests=True):
-        super().__init__(paths, skip_tests)
+        # When __init__.py was changed we should rescan the all packages
+        # which placed under it. We will be use pathes as target prefixes
         self.target_prefixes = []
+        for f in files:
+            self.target_prefixes.append(f)
+            if os.path.basename(f) == '__init__.py':
+                self.target_prefixes.append(os.path.dirname(f))
+
+    def build(self, report_listener=None):
+        self._report_listener = report_listener
+
+        with self.timer.measure('walk'):
+            for target in self._get_targets():
+                for root in self.paths:
+                    packages = self._get_packages(root, target)
+                    if packages is not None:
+                        self._index.index_target(packages, target)
+
+    def _get_targets(self):
+        # Changed packages are indexed with all their modules
+        packages = set()
+        for f in self.files:
+            if not os.path.exists(f):
+                # Removed files can't be found but they're still in index
+                self.affected_files.add(f)
+            elif os.path.basename(f) == '__init__.py':
+                packages.add(os.path.dirname(f))
+
+        targets = set(packages)
+        for f in self.files:
+            if not os.path.isfile(f):
+                continue
+            if not any(f.startswith(os.path.join(p, '')) for p in packages):
+                targets.add(f)
+        return sorted(targets)
+
+    def _get_packages(self, root, target):
+        # Directories between the root and the target. All of them should
+        # be packages which SymbolIndex.index_path() would enter
+        if not target.startswith(os.path.join(root, '')):
+            return None
+
+        packages = []
+        path = root
+        for name in os.path.relpath(target, root).split(os.path.sep)[:-1]:
+            path = os.path.join(path, name)
+            if name.startswith('_') or \
+                    not os.path.isfile(os.path.join(path, '__init__.py')):
+                return None
+            packages.append(path)
+        return packages
@@ -0,0 +1,206 @@
+import json
+import os
+from hashlib import md5
+
+MANIFEST_VERSION = 1
+
+
+def get_fingerprint(paths):
+    """
+    Changes when packages are installed, upgraded or removed: entries of
+    the roots and their .dist-info directories are added or replaced. Only
+    the roots are listed, so it's much cheaper than diff()
+    """
+    digest = md5()
+    for path in paths:
+        try:
+            entries = sorted(os.scandir(path), key=lambda e: e.name)
+        except OSError:
+            continue
+        for entry in entries:
+            try:
+                mtime = entry.stat().st_mtime_ns
+            except OSError:
+                continue
+            digest.update(('%s\0%s\0%i\n' % (path, entry.name, mtime)).encode(
+                'utf-8', 'surrogateescape'))
+    return digest.hexdigest()
+
+
+class Manifest(object):
+    """
+    Keeps mtime, size and optional content hash of every indexed file and
+    mtime of every scanned directory. It allows to find out what was changed
+    since the last commit without walking through the whole paths again
+    """
+    def __init__(self, file_path, use_hash=False):
+        self._file_path = file_path
+        self.use_hash = use_hash
+        self.files = {}  # filename -> [mtime, size, hash]
+        self.dirs = {}  # dirname -> mtime
+        self.fingerprint = None  # Of the roots, see get_fingerprint()
+        self._dirty = False
+
+    def load(self):
+        try:
+            with open(self._file_path, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return False
+
+        if data.get('version') != MANIFEST_VERSION:
+            return False
+
+        self.files = data.get('files', {})
+        self.dirs = data.get('dirs', {})
+        self.fingerprint = data.get('fingerprint')
+        self._dirty = False
+        return True
+
+    def save(self):
+        tmp_path = self._file_path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(dict(
+                    version=MANIFEST_VERSION,
+                    files=self.files,
+                    dirs=self.dirs,
+                    fingerprint=self.fingerprint), f)
+            os.replace(tmp_path, self._file_path)
+        except OSError:
+            pass
+        self._dirty = False
+
+    def save_if_dirty(self):
+        if self._dirty:
+            self.save()
+
+    def clear(self):
+        self.files = {}
+        self.dirs = {}
+        self.fingerprint = None
+        self._dirty = True
+
+    def update_fingerprint(self, fingerprint):
+        if fingerprint != self.fingerprint:
+            self.fingerprint = fingerprint
+            self._dirty = True
+
+    def update_file(self, filename):
+        try:
+            st = os.stat(filename)
+        except OSError:
+            if self.files.pop(filename, None) is not None:
+                self._dirty = True
+            return
+
+        content_hash = self._get_hash(filename) if self.use_hash else None
+        self.files[filename] = [st.st_mtime, st.st_size, content_hash]
+        self._dirty = True
+
+    def update_dir(self, dirname):
+        try:
+            self.dirs[dirname] = os.stat(dirname).st_mtime
+        except OSError:
+            self.dirs.pop(dirname, None)
+        self._dirty = True
+
+    def is_unchanged(self, filename):
+        entry = self.files.get(filename)
+        if entry is None:
+            return False
+
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return False
+
+        mtime, size, content_hash = entry
+        if st.st_mtime == mtime and st.st_size == size:
+            return True
+        return bool(content_hash) and st.st_size == size and \
+            self._get_hash(filename) == content_hash
+
+    def diff(self, blacklist_re=None):
+        """
+        Returns the list of files which were added, changed or removed
+        """
+        changed = set()
+
+        for filename, (mtime, size, content_hash) in list(self.files.items()):
+            try:
+                st = os.stat(filename)
+            except OSError:
+                changed.add(filename)
+                if os.path.basename(filename) == '__init__.py':
+                    # The package is gone. Its modules gone too
+                    changed.update(self._files_under(
+                        os.path.dirname(filename)))
+                continue
+
+            if st.st_mtime == mtime and st.st_size == size:
+                continue
+
+            if content_hash and st.st_size == size and \
+                    self._get_hash(filename) == content_hash:
+                # Only mtime was changed
+                self.files[filename][0] = st.st_mtime
+                self._dirty = True
+                continue
+
+            changed.add(filename)
+
+        for dirname, mtime in list(self.dirs.items()):
+            try:
+                current_mtime = os.stat(dirname).st_mtime
+            except OSError:
+                self.dirs.pop(dirname)
+                self._dirty = True
+                continue
+
+            if current_mtime == mtime:
+                continue
+
+            # Something was added or removed there
+            self.dirs[dirname] = current_mtime
+            self._dirty = True
+            changed.update(self._find_new_files(dirname, blacklist_re))
+
+        return sorted(changed)
+
+    def _files_under(self, dirname):
+        prefix = dirname + os.path.sep
+        return [f for f in self.files if f.startswith(prefix)]
+
+    def _find_new_files(self, dirname, blacklist_re):
+        # Follow rules of SymbolIndex.index_path()
+        new_files = []
+        try:
+            entries = os.listdir(dirname)
+        except OSError:
+            return new_files
+
+        for basename in entries:
+            filename = os.path.join(dirname, basename)
+            if os.path.splitext(basename)[0] != '__init__' and \
+                    basename.startswith('_'):
+                continue
+            if blacklist_re and blacklist_re.search(filename):
+                continue
+
+            if filename.endswith('.py') and os.path.isfile(filename):
+                if filename not in self.files:
+                    new_files.append(filename)
+            elif filename not in self.dirs and os.path.isfile(
+                    os.path.join(filename, '__init__.py')):
+                # New package. Everything inside is new
+                new_files.extend(self._find_new_files(filename, blacklist_re))
+        return new_files
+
+    @staticmethod
+    def _get_hash(filename):
+        try:
+            with open(filename, 'rb') as f:
+                return md5(f.read()).hexdigest()
+        except OSError:
+            return None
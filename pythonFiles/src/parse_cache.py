@@ -0,0 +1,69 @@
+import json
+import os
+import sys
+from hashlib import md5
+
+
+class ParseCache(object):
+    """
+    Content-addressed storage of parsed modules. It's shared between
+    workspaces, so the same site-packages don't need to be parsed again
+    """
+    def __init__(self, cache_path, max_size, version):
+        # Entries of the other interpreters or index versions are kept apart
+        self._path = os.path.join(cache_path, 'py%i%i-v%s' % (
+            sys.version_info[0], sys.version_info[1], version))
+        self.max_size = max_size
+
+    def _get_entry_path(self, source):
+        key = md5(source).hexdigest()
+        return os.path.join(self._path, key[:2], key)
+
+    def get(self, source):
+        entry_path = self._get_entry_path(source)
+        try:
+            with open(entry_path, 'r') as f:
+                success, symbols = json.load(f)
+            os.utime(entry_path)  # Mark as recently used
+        except (OSError, ValueError):
+            return
+        return success, [tuple(s) for s in symbols]
+
+    def put(self, source, success, symbols):
+        entry_path = self._get_entry_path(source)
+        tmp_path = '%s.%i.tmp' % (entry_path, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+            with open(tmp_path, 'w') as f:
+                json.dump([success, symbols], f)
+            os.replace(tmp_path, entry_path)
+        except OSError:
+            pass
+
+    def evict(self):
+        # Drop least recently used entries until the cache fits max_size.
+        # Indexes of the server are kept in cache_path too, they don't count
+        entries = []
+        total_size = 0
+        for root, _, filenames in os.walk(self._path):
+            for filename in filenames:
+                entry_path = os.path.join(root, filename)
+                try:
+                    st = os.stat(entry_path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, entry_path))
+                total_size += st.st_size
+
+        if total_size <= self.max_size:
+            return
+
+        entries.sort()
+        for _, size, entry_path in entries:
+            try:
+                os.remove(entry_path)
+            except OSError:
+                continue
+            total_size -= size
+            if total_size <= self.max_size * 0.9:
+                break
@@ -0,0 +1,146 @@
+import os
+import socket
+import threading
+import time
+
+from src.daemon import ImportMagicDaemon
+
+
+class ServerSession(ImportMagicDaemon):
+    """
+    Connection of one workspace. It speaks the protocol of the stdio daemon,
+    errors are sent over the same socket
+    """
+    def __init__(self, server, connection):
+        self._server = server
+        self._connection = connection
+        self._exit_lock = threading.Lock()
+        output = connection.makefile('w', encoding='utf-8')
+        super().__init__(connection.makefile('r', encoding='utf-8'),
+                         output, output)
+
+    def _get_environment(self, data_path, paths):
+        # Every session of the same interpreter gets the same one
+        from src.environment import Environment
+        key = Environment.get_key(self, paths)
+        return self._server.get_environment(key, lambda: Environment(
+            self, os.path.join(self.cache_path, 'environments', key[:12]),
+            paths))
+
+    def _write(self, stream, response):
+        try:
+            super()._write(stream, response)
+        except (OSError, ValueError):  # The client has gone
+            self._exit()
+
+    def _exit(self):
+        # Queued tasks are finished, the others stop
+        with self._exit_lock:
+            if self._closed:
+                return
+            self._close()
+        try:
+            self._connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._connection.close()
+
+    def serve(self):
+        self.watch()
+        self._worker.join()
+
+
+class ImportMagicServer(object):
+    """
+    Serves several workspaces over a Unix domain socket. Indexes of the
+    interpreter roots are shared by the sessions, so memory and CPU depend
+    on the number of environments and not on the number of windows
+    """
+    IDLE_TIMEOUT = 600  # Seconds without sessions before exit
+    ACCEPT_TIMEOUT = 5
+
+    def __init__(self, socket_path, idle_timeout=None):
+        self.socket_path = socket_path
+        self.idle_timeout = self.IDLE_TIMEOUT if idle_timeout is None \
+            else idle_timeout
+        self._lock = threading.Lock()
+        self._environments = {}
+        self._sessions = set()
+        self._idle_since = time.time()
+
+    def get_environment(self, key, create):
+        # They are kept while the server works. A closed session can still
+        # be indexing one. A failed one is replaced, so it's claimed again
+        with self._lock:
+            environment = self._environments.get(key)
+            if environment is None or environment.failed:
+                environment = self._environments[key] = create()
+            return environment
+
+    def _is_idle(self):
+        with self._lock:
+            if self._sessions:
+                self._idle_since = time.time()
+                return False
+            return time.time() - self._idle_since > self.idle_timeout
+
+    def _serve_session(self, session):
+        try:
+            session.serve()
+        finally:
+            with self._lock:
+                self._sessions.discard(session)
+                self._idle_since = time.time()
+
+    def _bind(self):
+        # Returns None when the other server listens there
+        if os.path.exists(self.socket_path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.socket_path)
+                return None
+            except OSError:
+                # Left by a killed server
+                os.remove(self.socket_path)
+            finally:
+                probe.close()
+
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # Sessions can read any file, so only the user may connect
+        umask = os.umask(0o077)
+        try:
+            listener.bind(self.socket_path)
+        except OSError:
+            # The other server was started at the same time
+            listener.close()
+            return None
+        finally:
+            os.umask(umask)
+        listener.listen(16)
+        return listener
+
+    def serve_forever(self):
+        listener = self._bind()
+        if listener is None:
+            return False
+
+        listener.settimeout(self.ACCEPT_TIMEOUT)
+        try:
+            while not self._is_idle():
+                try:
+                    connection, _ = listener.accept()
+                except socket.timeout:
+                    continue
+                connection.settimeout(None)
+                session = ServerSession(self, connection)
+                with self._lock:
+                    self._sessions.add(session)
+                threading.Thread(target=self._serve_session, args=(session,),
+                                 daemon=True).start()
+        finally:
+            listener.close()
+            try:
+                os.remove(self.socket_path)
+            except OSError:
+                pass
+        return True
@@ -0,0 +1,228 @@
+import mmap
+import os
+import struct
+from array import array
+from bisect import bisect_right
+
+from src.symbol_search import SymbolSearch, normalize
+
+SNAPSHOT_VERSION = 1
+
+# Native byte order: a snapshot of the other platform has a wrong version
+_HEADER = struct.Struct('=6sHqI')  # Magic, version, generation, documents
+_SECTION = struct.Struct('=QQ')  # Offset, size
+_MAGIC = b'IMSNAP'
+_SECTIONS = (
+    'norms', 'norm_offsets', 'symbols', 'symbol_offsets', 'modules',
+    'module_offsets', 'doc_modules', 'filenames', 'filename_offsets',
+    'doc_filenames', 'kinds', 'locations', 'sorts')
+_ALIGNMENT = 8
+
+
+def _pack_strings(strings):
+    # Joined by new lines. Item i is blob[offsets[i]:offsets[i + 1] - 1]
+    encoded = [s.encode('utf-8') for s in strings]
+    offsets = array('I', [0])
+    position = 0
+    for item in encoded:
+        position += len(item) + 1
+        offsets.append(position)
+    return b'\n'.join(encoded) + b'\n', offsets
+
+
+def _pack_table(values):
+    # Distinct values and the index of every value in them
+    ids = {}
+    column = array('I', (ids.setdefault(value, len(ids)) for value in values))
+    blob, offsets = _pack_strings(list(ids))
+    return blob, offsets, column
+
+
+def write_snapshot(file_path, documents, generation):
+    """
+    Writes documents ordered by descending sort. Documents are dicts like
+    in the index: symbol, module, kind, location, filename and sort
+    """
+    symbols, modules, kinds, locations, filenames, sorts = \
+        [], [], [], [], [], []
+    for doc in documents:
+        symbols.append(doc['symbol'])
+        modules.append(doc['module'])
+        kinds.append(doc['kind'])
+        locations.append(doc['location'])
+        filenames.append(doc.get('filename') or '')
+        sorts.append(doc['sort'] or 0)
+
+    order = sorted(range(len(symbols)), key=sorts.__getitem__, reverse=True)
+    symbols = [symbols[i] for i in order]
+
+    sections = {}
+    sections['norms'], sections['norm_offsets'] = \
+        _pack_strings(normalize(symbol) for symbol in symbols)
+    sections['symbols'], sections['symbol_offsets'] = \
+        _pack_strings(symbols)
+    sections['modules'], sections['module_offsets'], \
+        sections['doc_modules'] = _pack_table(modules[i] for i in order)
+    sections['filenames'], sections['filename_offsets'], \
+        sections['doc_filenames'] = _pack_table(filenames[i] for i in order)
+    sections['kinds'] = ''.join(kinds[i] for i in order).encode('ascii')
+    sections['locations'] = ''.join(
+        locations[i] for i in order).encode('ascii')
+    sections['sorts'] = array('i', (sorts[i] for i in order))
+
+    tmp_path = '%s.%i.tmp' % (file_path, os.getpid())
+    try:
+        with open(tmp_path, 'wb') as f:
+            position = _HEADER.size + _SECTION.size * len(_SECTIONS)
+            table = []
+            for name in _SECTIONS:
+                position += -position % _ALIGNMENT
+                size = memoryview(sections[name]).nbytes
+                table.append(_SECTION.pack(position, size))
+                position += size
+
+            f.write(_HEADER.pack(_MAGIC, SNAPSHOT_VERSION, generation,
+                                 len(symbols)))
+            f.write(b''.join(table))
+            for name in _SECTIONS:
+                f.write(b'\0' * (-f.tell() % _ALIGNMENT))
+                f.write(sections[name])
+        # Opened snapshots keep the old file
+        os.replace(tmp_path, file_path)
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class Snapshot(object):
+    """
+    Read-only symbol table which is mapped into memory. Nothing is parsed
+    on open, so searches are answered at once. The page cache is shared by
+    all daemons which use it. Changes after it was written are kept in
+    memory: documents of removed files are skipped and added ones are
+    searched in SymbolSearch
+    """
+    def __init__(self, file_path):
+        with open(file_path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, self.generation, self._count = \
+            _HEADER.unpack_from(self._mm)
+        if magic != _MAGIC or version != SNAPSHOT_VERSION:
+            raise ValueError('Incompatible snapshot')
+
+        view = memoryview(self._mm)
+        sections = {}
+        starts = {}
+        for i, name in enumerate(_SECTIONS):
+            offset, size = _SECTION.unpack_from(
+                self._mm, _HEADER.size + i * _SECTION.size)
+            if offset + size > len(self._mm):
+                raise ValueError('Truncated snapshot')
+            sections[name] = view[offset:offset + size]
+            starts[name] = offset
+
+        # Norms are searched in the map itself
+        self._norms_start = starts['norms']
+        self._norms_end = self._norms_start + len(sections['norms'])
+        self._norm_offsets = sections['norm_offsets'].cast('I')
+        self._symbols = sections['symbols']
+        self._symbol_offsets = sections['symbol_offsets'].cast('I')
+        self._modules = sections['modules']
+        self._module_offsets = sections['module_offsets'].cast('I')
+        self._doc_modules = sections['doc_modules'].cast('I')
+        self._filenames = sections['filenames']
+        self._filename_offsets = sections['filename_offsets'].cast('I')
+        self._doc_filenames = sections['doc_filenames'].cast('I')
+        self._kinds = sections['kinds']
+        self._locations = sections['locations']
+        self._sorts = sections['sorts'].cast('i')
+        if len(self._norm_offsets) != self._count + 1:
+            raise ValueError('Broken snapshot')
+
+        self._filename_ids = None
+        self._deleted = frozenset()  # Ids of removed filenames
+        self._overlay = SymbolSearch()
+        self.changes_count = 0  # Documents in the overlay
+
+    @classmethod
+    def open(cls, file_path):
+        try:
+            return cls(file_path)
+        except (OSError, ValueError, struct.error):
+            return None
+
+    def __len__(self):
+        return self._count
+
+    @staticmethod
+    def _get_string(blob, offsets, index):
+        return str(blob[offsets[index]:offsets[index + 1] - 1], 'utf-8')
+
+    def _get_document(self, doc_id):
+        return dict(
+            symbol=self._get_string(
+                self._symbols, self._symbol_offsets, doc_id),
+            module=self._get_string(
+                self._modules, self._module_offsets,
+                self._doc_modules[doc_id]),
+            kind=chr(self._kinds[doc_id]),
+            location=chr(self._locations[doc_id]),
+            filename=self._get_string(
+                self._filenames, self._filename_offsets,
+                self._doc_filenames[doc_id]),
+            sort=self._sorts[doc_id])
+
+    def update(self, removed_files, documents):
+        # It's called by the indexing thread only
+        if self._filename_ids is None:
+            self._filename_ids = {
+                self._get_string(
+                    self._filenames, self._filename_offsets, i): i
+                for i in range(len(self._filename_offsets) - 1)}
+        removed_ids = {self._filename_ids[filename]
+                       for filename in removed_files
+                       if filename in self._filename_ids}
+        if removed_ids:
+            self._deleted = self._deleted | removed_ids
+        self._overlay.remove(removed_files)
+        self._overlay.add(documents)
+        self.changes_count += len(documents)
+
+    def search(self, text, limit=50):
+        # Substring search like SymbolSearch does. The blob of normalized
+        # symbols is scanned, documents there are ordered by sort
+        needle = normalize(text).encode('utf-8')
+        if not needle:
+            return []
+
+        deleted = self._deleted
+        mm = self._mm
+        offsets = self._norm_offsets
+        start = self._norms_start
+        position = start
+        found = []
+        while len(found) < limit:
+            position = mm.find(needle, position, self._norms_end)
+            if position < 0:
+                break
+            doc_id = bisect_right(offsets, position - start) - 1
+            position = start + offsets[doc_id + 1]
+            if not deleted or self._doc_filenames[doc_id] not in deleted:
+                found.append(doc_id)
+
+        items = [self._get_document(doc_id) for doc_id in found]
+        if len(self._overlay):
+            items.extend(self._overlay.search(text, limit))
+            items.sort(key=lambda item: item['sort'], reverse=True)
+            del items[limit:]
+        return items
+
+    def iter_documents(self):
+        deleted = self._deleted
+        for doc_id in range(self._count):
+            if not deleted or self._doc_filenames[doc_id] not in deleted:
+                yield self._get_document(doc_id)
+        for doc in self._overlay.iter_documents():
+            yield doc
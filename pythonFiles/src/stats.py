@@ -0,0 +1,188 @@
+import io
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds of latency histogram buckets, milliseconds
+LATENCY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000,
+                   10000)
+
+
+def get_memory_usage():
+    # Megabytes. Current RSS is known on Linux only
+    usage = dict(rss_mb=None, peak_rss_mb=None)
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        usage['rss_mb'] = round(
+            pages * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024, 1)
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Kilobytes, but bytes on macOS
+        usage['peak_rss_mb'] = round(
+            peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+    except ImportError:  # Windows
+        pass
+    return usage
+
+
+class RequestStats(object):
+    """
+    Counts of requests and their latencies by action. Requests are handled
+    by the main and the indexing threads
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._actions = {}
+
+    def add(self, action, seconds, error=False):
+        bucket = len(LATENCY_BUCKETS)
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds * 1000 <= bound:
+                bucket = i
+                break
+
+        with self._lock:
+            stats = self._actions.get(action)
+            if stats is None:
+                stats = self._actions[action] = dict(
+                    count=0, errors=0, total=0.0, max=0.0,
+                    histogram=[0] * (len(LATENCY_BUCKETS) + 1))
+            stats['count'] += 1
+            stats['errors'] += error
+            stats['total'] += seconds
+            stats['max'] = max(stats['max'], seconds)
+            stats['histogram'][bucket] += 1
+
+    def get_stats(self):
+        result = {}
+        with self._lock:
+            for action, stats in self._actions.items():
+                labels = ['<=%i' % b for b in LATENCY_BUCKETS] + \
+                    ['>%i' % LATENCY_BUCKETS[-1]]
+                result[action] = dict(
+                    count=stats['count'],
+                    errors=stats['errors'],
+                    mean_ms=round(stats['total'] / stats['count'] * 1000, 3),
+                    max_ms=round(stats['max'] * 1000, 3),
+                    histogram_ms={label: count for label, count in zip(
+                        labels, stats['histogram']) if count})
+        return result
+
+
+class PhaseTimer(object):
+    """
+    Seconds spent in the phases of indexing. Phases can be nested: the
+    time of the inner one isn't counted in the outer one
+    """
+    def __init__(self):
+        self.phases = {}
+        self._stack = []  # Time of the inner phases
+
+    @contextmanager
+    def measure(self, name):
+        started = time.perf_counter()
+        self._stack.append(0.0)
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            inner = self._stack.pop()
+            self.phases[name] = self.phases.get(name, 0.0) + elapsed - inner
+            if self._stack:
+                self._stack[-1] += elapsed
+
+    def get_stats(self):
+        return {name: round(seconds, 3)
+                for name, seconds in self.phases.items()}
+
+
+class Profiler(object):
+    """
+    Profiles the next requests with cProfile and optionally traces memory
+    allocations. Results are written to files when the last one is done.
+    The modules are imported when it's started, they slow down startup
+    """
+    TOP_ITEMS = 50  # Lines of the text report
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._remaining = 0
+        self._running = False  # cProfile can't profile two threads at once
+        self._stats = None
+        self._file_path = None
+        self._memory = False
+        self.files = []  # Results of the last run
+
+    @property
+    def remaining(self):
+        return self._remaining
+
+    def start(self, file_path, requests, memory=False):
+        # file_path is a prefix of the result files
+        import tracemalloc
+        with self._lock:
+            if self._memory and not memory:
+                tracemalloc.stop()
+            self._remaining = requests
+            self._stats = None
+            self._file_path = file_path
+            self._memory = memory
+            if memory and not tracemalloc.is_tracing():
+                tracemalloc.start()
+
+    def run(self, func, *args, **kwargs):
+        with self._lock:
+            profiled = self._remaining > 0 and not self._running
+            if profiled:
+                self._remaining -= 1
+                self._running = True
+        if not profiled:
+            return func(*args, **kwargs)
+
+        import cProfile
+        import pstats
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(func, *args, **kwargs)
+        finally:
+            with self._lock:
+                self._running = False
+                if self._stats is None:
+                    self._stats = pstats.Stats(profile)
+                else:
+                    self._stats.add(profile)
+                if not self._remaining:
+                    try:
+                        self._dump()
+                    except OSError:
+                        self.files = []
+
+    def _dump(self):
+        report = io.StringIO()
+        self._stats.stream = report
+        self._stats.sort_stats('cumulative').print_stats(self.TOP_ITEMS)
+        self._stats.dump_stats(self._file_path + '.prof')
+        files = [self._file_path + '.prof']
+
+        if self._memory:
+            import tracemalloc
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            self._memory = False
+            snapshot.dump(self._file_path + '.tracemalloc')
+            files.append(self._file_path + '.tracemalloc')
+            report.write('\nTop allocations:\n')
+            for stat in snapshot.statistics('lineno')[:self.TOP_ITEMS]:
+                report.write('%s\n' % stat)
+
+        with open(self._file_path + '.txt', 'w') as f:
+            f.write(report.getvalue())
+        files.append(self._file_path + '.txt')
+        self._stats = None
+        self.files = files
@@ -1,41 +1,103 @@
 import os
-from contextlib import contextmanager
+import sys
+from contextlib import ExitStack, contextmanager
+import importmagic
 from importmagic import SymbolIndex
 
+# Scores are a few distinct values. Symbols from the parse cache or worker
+# processes would otherwise get their own float objects
+_shared_scores = {}
 
-class SymbolIndexAccelerator(object):
-    def path(self):
-        if not hasattr(self, '_cached_path'):
-            path = []
-            node = self
-            while node and node._name:
-                path.append(node._name)
-                node = node._parent
-            setattr(self, '_cached_path', '.'.join(reversed(path)))
-        return getattr(self, '_cached_path')
 
-    def depth(self):
-        if not hasattr(self, '_cached_depth'):
-            depth = 0
-            node = self
-            while node._parent:
-                depth += 1
-                node = node._parent
-            setattr(self, '_cached_depth', depth)
-        return getattr(self, '_cached_depth')
+class SymbolRecorder(object):
+    """
+    Collects symbols which SymbolVisitor found. They will be applied to
+    the tree later (possibly in the other process)
+    """
+    def __init__(self):
+        self.symbols = []
+
+    def add(self, name, score):
+        self.symbols.append((name, score, False))
+
+    def add_explicit_export(self, name, score):
+        self.symbols.append((name, score, True))
+
 
+def parse_module(filename, parse_cache=None):
+    # Picklable entry point for worker processes
+    with open(filename, 'rb') as fd:
+        source = fd.read()
 
-class ExtendedSymbolIndex(SymbolIndex, SymbolIndexAccelerator):
+    if parse_cache is not None:
+        result = parse_cache.get(source)
+        if result is not None:
+            return result
+
+    recorder = SymbolRecorder()
+    success = SymbolIndex.index_source(recorder, filename, source)
+
+    if parse_cache is not None:
+        parse_cache.put(source, success, recorder.symbols)
+    return success, recorder.symbols
+
+
+class ExtendedSymbolIndex(object):
     """
-    Extend base class for keep a filename
+    Slotted variant of SymbolIndex which keeps a filename. Environments have
+    many thousands of modules, so nodes shouldn't carry a __dict__ each
     """
+    __slots__ = ('_name', '_tree', '_exports', '_parent', '_lib_locations',
+                 '_path', '_depth', 'score', 'location', 'filename',
+                 'manager')
+
+    # SymbolIndex has no __slots__, so its methods are borrowed instead
+    lib_locations = SymbolIndex.lib_locations
+    index_path = SymbolIndex.index_path
+    _index_module = SymbolIndex._index_module
+    index_builtin = SymbolIndex.index_builtin
+    add = SymbolIndex.add
+    add_explicit_export = SymbolIndex.add_explicit_export
+    find = SymbolIndex.find
+    location_for = SymbolIndex.location_for
+    boost = SymbolIndex.boost
+    _merge_aliases = SymbolIndex._merge_aliases
+    _determine_location_for = SymbolIndex._determine_location_for
+    __repr__ = SymbolIndex.__repr__
+
     def __init__(self, name=None, parent=None, score=1.0, location='L',
-                 blacklist_re=None, locations=None, filename=None, 
-                manager=None):
+                 locations=None, filename=None, manager=None):
+        self._name = name
+        self._tree = {}
+        self._exports = None
+        self._parent = parent
+        self.score = score
+        self.location = location
         self.filename = filename
         self.manager = manager
-        super().__init__(name, parent, score, 
-            location, blacklist_re, locations)
+        if parent is None:
+            self._lib_locations = locations or \
+                importmagic.index.LIB_LOCATIONS
+            self._path = name or ''
+            self._depth = 0
+            if manager is None or manager.builtins:
+                # Project indexes don't have the aliased stdlib modules
+                self._merge_aliases()
+                with self.enter('__future__', location='F'):
+                    pass
+                with self.enter('__builtin__', location='S'):
+                    pass
+        else:
+            self._lib_locations = None
+            self._path = sys.intern('%s.%s' % (parent._path, name)
+                                    if parent._path else name)
+            self._depth = parent._depth + 1
+
+    def path(self):
+        return self._path
+
+    def depth(self):
+        return self._depth
 
     def get_power(self):
         items_count = 0
@@ -46,7 +108,25 @@ class ExtendedSymbolIndex(SymbolIndex, SymbolIndexAccelerator):
         return items_count
 
     def build_index(self):
-        super().build_index(self.manager.paths)
+        # Same as SymbolIndex.build_index() but the manager gets every
+        # complete top-level module
+        if self.manager.builtins:
+            for name in importmagic.index.BUILTIN_MODULES:
+                self.index_builtin(name, location='S')
+            self.manager.flush()
+
+        for path in self.manager.paths:
+            if not os.path.isdir(path):
+                continue
+            self.manager.scanned_dirs.add(path)
+            for filename in os.listdir(path):
+                name = os.path.splitext(filename)[0]
+                if self.manager.is_claimed(name):
+                    continue
+                self.index_path(os.path.join(path, filename))
+                if name in self._tree:
+                    self.manager.claim(name)
+                self.manager.flush()
     
     def index_file(self, module, filename):
         location = self._determine_location_for(filename)
@@ -63,21 +143,59 @@ class ExtendedSymbolIndex(SymbolIndex, SymbolIndexAccelerator):
                     break
             if not ok:
                 return
+            if self.manager.is_unchanged and \
+                    self.manager.is_unchanged(filename):
+                # Its symbols and its entry are in the index already
+                return
             self.manager.affected_files.add(filename)
+        self.manager.indexed_files.add(filename)
 
-        # logger.debug('parsing Python module %s for indexing', filename)
-        with open(filename, 'rb') as fd:
-            source = fd.read()
         with self.enter(module, 
             location=location,  # self._determine_location_for(filename), 
             filename=filename) as subtree:
-            success = subtree.index_source(filename, source)
+            # Project files are changed too often to be cached
+            parse_cache = self.manager.parse_cache if location != 'L' \
+                else None
+            if self.manager.defer_parsing(self, module, subtree, filename,
+                                          parse_cache):
+                return
+            with self.manager.timer.measure('parse'):
+                success, symbols = parse_module(filename, parse_cache)
+        self.apply_symbols(module, subtree, success, symbols)
+
+    def apply_symbols(self, module, subtree, success, symbols):
         if not success:
-            self._tree.pop(module, None)
+            if self._tree.get(module) is subtree:
+                self._tree.pop(module, None)
+            return
+
+        for name, score, explicit in symbols:
+            name = sys.intern(name)
+            score = _shared_scores.setdefault(score, score)
+            if explicit:
+                subtree.add_explicit_export(name, score)
+            else:
+                subtree.add(name, score)
+        subtree.delete_unexported()
+        # Only symbols of the module itself are pruned. They're all applied
+        subtree._exports = None
+
+    def index_target(self, packages, target):
+        # Enter the parent packages without listing them
+        with ExitStack() as stack:
+            scope = self
+            for package in packages:
+                scope = stack.enter_context(scope.enter(
+                    os.path.basename(package),
+                    location=self._determine_location_for(package),
+                    filename=os.path.join(package, '__init__.py')))
+            scope.index_path(target)
 
     def _index_package(self, root, location):
         root_filename = os.path.join(root, '__init__.py')
 
+        self.manager.scanned_dirs.add(root)
+
         basename = os.path.basename(root)
         with self.enter(basename, location=location, 
             filename=root_filename) as subtree:
@@ -89,8 +207,9 @@ class ExtendedSymbolIndex(SymbolIndex, SymbolIndexAccelerator):
         if name is None:
             tree = self
         else:
+            name = sys.intern(name)
             tree = self._tree.get(name)
-            if not isinstance(tree, SymbolIndex):
+            if not isinstance(tree, ExtendedSymbolIndex):
                 tree = self._tree[name] = ExtendedSymbolIndex(name, self, 
                     score=score, location=location, filename=filename, 
                     manager=self.manager)
@@ -100,9 +219,12 @@ class ExtendedSymbolIndex(SymbolIndex, SymbolIndexAccelerator):
                     alias._tree = tree._tree
 
         yield tree
-        if tree._exports is not None:
+        tree.delete_unexported()
+
+    def delete_unexported(self):
+        if self._exports is not None:
             # Delete unexported variables. But keeps submodules
-            for key in set(tree._tree) - set(tree._exports):
-                value = tree._tree.get(key)
+            for key in set(self._tree) - set(self._exports):
+                value = self._tree.get(key)
                 if value is None or type(value) is float:
-                    del tree._tree[key]
+                    del self._tree[key]
@@ -0,0 +1,333 @@
+import re
+import sys
+import threading
+from array import array
+from itertools import combinations
+
+HUMPS_RE = re.compile(r'[A-Z]+(?![a-z])|[A-Z]?[a-z]+|[0-9]+')
+
+
+def normalize(text):
+    # Same as symbol analyzer does: LowercaseFilter() | LodashFilter()
+    return text.lower().replace('_', '')
+
+
+def trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def split_humps(symbol):
+    # DataFrameReader -> data, frame, reader; read_csv -> read, csv
+    return [hump.lower() for hump in HUMPS_RE.findall(symbol)]
+
+
+def hump_pairs(humps):
+    initials = [hump[0] for hump in humps[:6]]
+    return {a + b for a, b in combinations(initials, 2)}
+
+
+def match_humps(text, humps, start=0, hump_index=0):
+    # Every part of text should be a prefix of the next humps
+    if start == len(text):
+        return True
+    for i in range(hump_index, len(humps)):
+        hump = humps[i]
+        size = min(len(hump), len(text) - start)
+        while size > 0:
+            if hump[:size] == text[start:start + size] and \
+                    match_humps(text, humps, start + size, i + 1):
+                return True
+            size -= 1
+    return False
+
+
+def is_subsequence(text, norm):
+    chars = iter(norm)
+    return all(c in chars for c in text)
+
+
+def substring_distance(text, norm, max_distance):
+    # Edit distance between text and the best matching part of norm
+    previous = [0] * (len(norm) + 1)
+    for i, c in enumerate(text, 1):
+        current = [i]
+        for j, n in enumerate(norm, 1):
+            current.append(min(
+                previous[j] + 1,
+                current[j - 1] + 1,
+                previous[j - 1] + (c != n)))
+        if min(current) > max_distance:
+            return max_distance + 1
+        previous = current
+    return min(previous)
+
+
+class SymbolSearch(object):
+    """
+    In-memory substring search over symbol names. Documents are kept in
+    the order of descending `sort`, so trigram postings are sorted by
+    relevance too and a search stops as soon as the limit is reached.
+    Documents added later go to an unsorted tail until the next compaction.
+    Only one thread may change it, but searches can run from the others
+    """
+    COMPACT_RATIO = 0.1
+
+    # Fuzzy search: how much match quality weights against sort score
+    QUALITY_WEIGHT = 1000
+    FUZZY_SCAN_LIMIT = 1000  # Candidates which are checked per source
+    TYPO_SCAN_LIMIT = 200
+
+    def __init__(self, fuzzy=False):
+        self.fuzzy = fuzzy  # Keep postings for fuzzy_search()
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self._symbols = []
+        self._modules = []
+        self._kinds = []
+        self._locations = []
+        self._filenames = []
+        self._sorts = []
+        self._norms = []
+        self._postings = {}
+        self._hump_postings = {}
+        self._first_chars = {}
+        self._by_filename = {}
+        self._deleted = set()
+        self._sorted_count = 0  # Documents before it are ordered by sort
+
+    def __len__(self):
+        return len(self._symbols) - len(self._deleted)
+
+    def build(self, documents):
+        self.clear()
+        self.add(documents)
+        self.compact()
+
+    def add(self, documents):
+        with self._lock:
+            for doc in documents:
+                doc_id = len(self._symbols)
+                filename = sys.intern(doc.get('filename') or '')
+                self._symbols.append(doc['symbol'])
+                self._modules.append(sys.intern(doc['module']))
+                self._kinds.append(doc['kind'])
+                self._locations.append(doc['location'])
+                self._filenames.append(filename)
+                self._sorts.append(doc['sort'] or 0)
+                self._norms.append(normalize(doc['symbol']))
+                self._by_filename.setdefault(filename, []).append(doc_id)
+
+        tail_size = len(self._symbols) - self._sorted_count
+        if tail_size > max(1000, len(self) * self.COMPACT_RATIO):
+            self.compact()
+
+    def iter_documents(self):
+        for doc_id in range(len(self._symbols)):
+            if doc_id not in self._deleted:
+                yield self._get_document(doc_id)
+
+    def remove(self, filenames):
+        with self._lock:
+            for filename in filenames:
+                self._deleted.update(self._by_filename.pop(filename, ()))
+
+    def compact(self):
+        # Reorder all alive documents by sort and rebuild postings. It's
+        # built aside and swapped, so searches aren't blocked meanwhile
+        alive = [i for i in range(len(self._symbols))
+                 if i not in self._deleted]
+        alive.sort(key=self._sorts.__getitem__, reverse=True)
+
+        columns = (self._symbols, self._modules, self._kinds,
+                   self._locations, self._filenames, self._sorts,
+                   self._norms)
+        (symbols, modules, kinds, locations, filenames, sorts, norms) = \
+            [[column[i] for i in alive] for column in columns]
+
+        by_filename = {}
+        postings = {}
+        hump_postings = {}
+        first_chars = {}
+        for doc_id, (symbol, norm, filename) in enumerate(
+                zip(symbols, norms, filenames)):
+            by_filename.setdefault(filename, []).append(doc_id)
+            for i in range(len(norm) - 2):
+                gram = norm[i:i + 3]
+                posting = postings.get(gram)
+                if posting is None:
+                    postings[gram] = [doc_id]
+                elif posting[-1] != doc_id:
+                    posting.append(doc_id)
+            if not self.fuzzy:
+                continue
+            for pair in hump_pairs(split_humps(symbol)):
+                hump_postings.setdefault(pair, []).append(doc_id)
+            if norm:
+                first_chars.setdefault(norm[0], []).append(doc_id)
+
+        with self._lock:
+            (self._symbols, self._modules, self._kinds, self._locations,
+             self._filenames, self._sorts, self._norms) = \
+                (symbols, modules, kinds, locations, filenames, sorts, norms)
+            self._deleted = set()
+            self._by_filename = by_filename
+            self._postings = {gram: array('I', posting)
+                              for gram, posting in postings.items()}
+            self._hump_postings = {pair: array('I', posting)
+                                   for pair, posting in hump_postings.items()}
+            self._first_chars = {c: array('I', posting)
+                                 for c, posting in first_chars.items()}
+            self._sorted_count = len(symbols)
+
+    def _get_candidates(self, text):
+        if len(text) < 3:
+            return range(self._sorted_count)
+
+        postings = []
+        for gram in trigrams(text):
+            posting = self._postings.get(gram)
+            if posting is None:
+                return ()
+            postings.append(posting)
+        return min(postings, key=len)
+
+    def _get_document(self, doc_id):
+        return dict(
+            symbol=self._symbols[doc_id],
+            module=self._modules[doc_id],
+            kind=self._kinds[doc_id],
+            location=self._locations[doc_id],
+            filename=self._filenames[doc_id],
+            sort=self._sorts[doc_id])
+
+    def search(self, pattern, limit=50, fuzzy=False):
+        with self._lock:
+            if fuzzy:
+                return self._fuzzy_search(pattern, limit)
+            return self._search(pattern, limit)
+
+    def _search(self, pattern, limit):
+        text = normalize(pattern)
+        norms = self._norms
+        deleted = self._deleted
+
+        found = []
+        for doc_id in self._get_candidates(text):
+            if text in norms[doc_id] and doc_id not in deleted:
+                found.append(doc_id)
+                if len(found) >= limit:
+                    break
+
+        # Unsorted documents which were added after the last compaction
+        tail = [doc_id for doc_id in range(self._sorted_count, len(norms))
+                if text in norms[doc_id] and doc_id not in deleted]
+        if tail:
+            found.extend(tail)
+            found.sort(key=self._sorts.__getitem__, reverse=True)
+            del found[limit:]
+
+        return [self._get_document(doc_id) for doc_id in found]
+
+    def _match_quality(self, text, doc_id):
+        norm = self._norms[doc_id]
+        if norm == text:
+            return 1.0
+        position = norm.find(text)
+        if position == 0:
+            return 0.9
+        if position < 0 and not is_subsequence(text, norm):
+            # Humps can't match too
+            return 0.0
+        humps = split_humps(self._symbols[doc_id])
+        if humps and humps[0].startswith(text[0]) and \
+                match_humps(text, humps):
+            return 0.85
+        if position > 0:
+            return 0.8 - min(position, 10) * 0.01
+        if match_humps(text, humps):
+            return 0.7
+        return 0.5
+
+    def _iter_fuzzy_sources(self, text):
+        tail = range(self._sorted_count, len(self._norms))
+
+        # Substrings, humps and subsequences. The first char should be
+        # a hump initial
+        yield self._get_candidates(text)
+        if len(text) > 1:
+            for c in sorted(set(text[1:]), key=text.index):
+                yield self._hump_postings.get(text[0] + c, ())
+        yield tail
+        yield self._first_chars.get(text[0], ())
+
+    def _get_typo_candidates(self, text, max_distance):
+        # Documents which share enough trigrams with the text
+        grams = trigrams(text)
+        required = max(1, len(grams) - 3 * max_distance)
+        counts = {}
+        for gram in grams:
+            for doc_id in self._postings.get(gram, ())[:self.FUZZY_SCAN_LIMIT]:
+                counts[doc_id] = counts.get(doc_id, 0) + 1
+        candidates = [doc_id for doc_id, count in counts.items()
+                      if count >= required]
+        # The most similar and the most relevant go first
+        candidates.sort(key=lambda doc_id: (-counts[doc_id], doc_id))
+        del candidates[self.TYPO_SCAN_LIMIT:]
+        candidates.extend(range(self._sorted_count, len(self._norms)))
+        return candidates
+
+    def fuzzy_search(self, pattern, limit=50):
+        """
+        Substring, CamelCase/snake_case humps, subsequence and typo-tolerant
+        search. Every source of candidates is scanned in order of
+        relevance and only up to FUZZY_SCAN_LIMIT documents
+        """
+        with self._lock:
+            return self._fuzzy_search(pattern, limit)
+
+    def _fuzzy_search(self, pattern, limit):
+        text = normalize(pattern)
+        if not text:
+            return []
+
+        deleted = self._deleted
+        enough = limit * 4
+        matched = {}
+        for source in self._iter_fuzzy_sources(text):
+            for doc_id in source[:self.FUZZY_SCAN_LIMIT]:
+                if doc_id in matched or doc_id in deleted:
+                    continue
+                quality = self._match_quality(text, doc_id)
+                if quality:
+                    matched[doc_id] = quality
+                    if len(matched) >= enough:
+                        break
+            if len(matched) >= enough:
+                break
+
+        # Typos are the last chance
+        max_distance = 2 if len(text) >= 8 else 1 if len(text) >= 4 else 0
+        if len(matched) < limit and max_distance:
+            norms = self._norms
+            for doc_id in self._get_typo_candidates(text, max_distance):
+                if doc_id in matched or doc_id in deleted:
+                    continue
+                distance = substring_distance(text, norms[doc_id],
+                                              max_distance)
+                if distance <= max_distance:
+                    matched[doc_id] = 0.4 - 0.1 * distance
+
+        sorts = self._sorts
+        weight = self.QUALITY_WEIGHT
+        ranks = {doc_id: matched[doc_id] * weight + sorts[doc_id]
+                 for doc_id in matched}
+        found = sorted(matched, key=ranks.__getitem__, reverse=True)
+        items = []
+        for doc_id in found[:limit]:
+            # Results of several indexes are merged by it
+            item = self._get_document(doc_id)
+            item['rank'] = ranks[doc_id]
+            items.append(item)
+        return items
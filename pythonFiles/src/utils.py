@@ -1,3 +1,4 @@
+from collections import OrderedDict
 from hashlib import md5
 import json
 
@@ -10,3 +11,36 @@ def pipeout(pipe, response):
     pipe.write(json.dumps(response))
     pipe.write('\n')
     pipe.flush()
+
+
+def pipeout_frame(pipe, response):
+    # "<length>:<json>". JSON is ASCII, so the length is the same in bytes
+    # and in characters of the decoded stream
+    data = json.dumps(response, separators=(',', ':'))
+    pipe.write('%i:%s' % (len(data), data))
+    pipe.flush()
+
+
+class LRUCache(object):
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._items = OrderedDict()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, default=None):
+        try:
+            self._items.move_to_end(key)
+        except KeyError:
+            return default
+        return self._items[key]
+
+    def put(self, key, value):
+        self._items[key] = value
+        self._items.move_to_end(key)
+        if len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def clear(self):
+        self._items.clear()
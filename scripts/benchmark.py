@@ -0,0 +1,403 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the daemon. It generates a synthetic project (optionally
+with a real site-packages), drives the daemon through its stdin/stdout
+protocol and prints JSON with latencies, peak RSS and index size.
+
+    python scripts/benchmark.py --packages 40 --output before.json
+    python scripts/benchmark.py --site-packages /usr/lib/python3/dist-packages
+    python scripts/benchmark.py --config '{"searchBackend": "memory"}'
+
+The same --seed generates the same tree and queries, so outputs of
+different revisions can be compared.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from queue import Empty, Queue
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DAEMON_PATH = os.path.join(ROOT, 'pythonFiles')
+
+WORDS = (
+    'account', 'adapter', 'agent', 'array', 'batch', 'buffer', 'cache',
+    'channel', 'client', 'column', 'config', 'context', 'cursor', 'data',
+    'device', 'event', 'field', 'filter', 'frame', 'graph', 'handler',
+    'header', 'image', 'index', 'item', 'job', 'key', 'layer', 'loader',
+    'manager', 'matrix', 'message', 'model', 'node', 'option', 'packet',
+    'parser', 'path', 'policy', 'pool', 'query', 'reader', 'record',
+    'request', 'result', 'route', 'schema', 'session', 'signal', 'source',
+    'stream', 'table', 'task', 'token', 'tree', 'user', 'value', 'vector',
+    'view', 'writer')
+VERBS = (
+    'build', 'check', 'close', 'convert', 'create', 'decode', 'encode',
+    'find', 'format', 'get', 'load', 'merge', 'open', 'parse', 'read',
+    'render', 'reset', 'save', 'send', 'set', 'split', 'update', 'write')
+
+
+class SyntheticProject(object):
+    """
+    Package tree with functions, classes and constants in every module.
+    Modules import a few symbols of each other like real code does
+    """
+    def __init__(self, root, packages, modules, depth, branching, symbols,
+                 seed):
+        self.root = root
+        self.symbols = []  # (module, symbol)
+        self.files = []
+        self._random = random.Random(seed)
+        self._modules = modules
+        self._branching = branching
+        self._symbols_count = symbols
+
+        os.makedirs(root)
+        for i in range(packages):
+            self._write_package(
+                os.path.join(root, '%s%i' % (self._word(), i)), depth)
+
+    def _word(self):
+        return self._random.choice(WORDS)
+
+    def _name(self, kind):
+        if kind == 'class':
+            return ''.join(self._word().capitalize() for _ in range(2))
+        if kind == 'constant':
+            return '%s_%s' % (self._word().upper(), self._word().upper())
+        return '%s_%s_%s' % (self._random.choice(VERBS), self._word(),
+                             self._word())
+
+    def _module_name(self, directory):
+        return os.path.relpath(directory, self.root).replace(os.sep, '.')
+
+    def _write_package(self, directory, depth):
+        os.makedirs(directory)
+        package = self._module_name(directory)
+        self._write_module(os.path.join(directory, '__init__.py'), package)
+        for i in range(self._modules):
+            name = '%s_%i' % (self._word(), i)
+            self._write_module(os.path.join(directory, name + '.py'),
+                               '%s.%s' % (package, name))
+        if depth > 1:
+            for i in range(self._branching):
+                self._write_package(
+                    os.path.join(directory, 'sub%s%i' % (self._word(), i)),
+                    depth - 1)
+
+    def _write_module(self, filename, module):
+        lines = []
+        for module_, symbol in self._random.sample(
+                self.symbols, min(3, len(self.symbols))):
+            lines.append('from %s import %s' % (module_, symbol))
+        lines.append('')
+
+        names = set()
+        for _ in range(self._symbols_count):
+            kind = self._random.choice(('function', 'class', 'constant'))
+            name = self._name(kind)
+            if name in names:
+                continue
+            names.add(name)
+            if kind == 'class':
+                lines.append('\nclass %s(object):' % name)
+                lines.append('    def %s(self, value):' % self._name(''))
+                lines.append('        return value\n')
+            elif kind == 'constant':
+                lines.append('%s = %i' % (name, self._random.randint(0, 99)))
+            else:
+                lines.append('\ndef %s(value=None):' % name)
+                lines.append('    return value\n')
+            self.symbols.append((module, name))
+
+        with open(filename, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        self.files.append(filename)
+
+
+class DaemonClient(object):
+    """
+    Runs importMagic.py like the extension does and waits for responses
+    """
+    def __init__(self, python):
+        self.started = time.perf_counter()
+        self._process = subprocess.Popen(
+            [python, '-W', 'ignore', 'importMagic.py'], cwd=DAEMON_PATH,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE, universal_newlines=True,
+            encoding='utf-8')
+        self._responses = Queue()
+        self._request_id = 0
+        for pipe in (self._process.stdout, self._process.stderr):
+            threading.Thread(target=self._read, args=(pipe,),
+                             daemon=True).start()
+
+    def _read(self, pipe):
+        for line in pipe:
+            try:
+                self._responses.put(json.loads(line))
+            except ValueError:
+                pass  # Warnings of libraries
+        self._responses.put(None)
+
+    def request(self, action, timeout=3600, **kwargs):
+        # Returns the response and its latency in seconds
+        self._request_id += 1
+        kwargs.update(action=action, requestId=self._request_id)
+        started = time.perf_counter()
+        self._process.stdin.write(json.dumps(kwargs) + '\n')
+        self._process.stdin.flush()
+        while True:
+            try:
+                response = self._responses.get(timeout=timeout)
+            except Empty:
+                raise RuntimeError('%s timed out' % action)
+            if response is None:
+                raise RuntimeError('Daemon exited (%s)' % action)
+            if response.get('id') != self._request_id:
+                continue  # Progress
+            elapsed = time.perf_counter() - started
+            if response.get('error'):
+                raise RuntimeError('%s failed: %s' % (
+                    action, response.get('message')))
+            return response, elapsed
+
+    def peak_rss(self):
+        # Megabytes. Only Linux reports it for a running process
+        try:
+            with open('/proc/%i/status' % self._process.pid) as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        return round(int(line.split()[1]) / 1024, 1)
+        except OSError:
+            pass
+        return None
+
+    def close(self):
+        self._process.kill()
+        self._process.wait()
+
+
+def summarize(latencies):
+    # Seconds -> milliseconds
+    if not latencies:
+        return None
+    values = sorted(latencies)
+
+    def percentile(p):
+        return values[min(len(values) - 1, int(len(values) * p))]
+    return dict(
+        count=len(values),
+        mean_ms=round(sum(values) / len(values) * 1000, 3),
+        p50_ms=round(percentile(0.50) * 1000, 3),
+        p99_ms=round(percentile(0.99) * 1000, 3),
+        max_ms=round(values[-1] * 1000, 3))
+
+
+def get_size(directory):
+    size = 0
+    for root, _, files in os.walk(directory):
+        for f in files:
+            try:
+                size += os.path.getsize(os.path.join(root, f))
+            except OSError:
+                pass
+    return round(size / 1024 / 1024, 2)
+
+
+def get_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+            stderr=subprocess.DEVNULL, universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def get_queries(project, count, rnd):
+    # Substrings of known symbols and some texts which aren't found
+    queries = []
+    for _ in range(count):
+        if rnd.random() < 0.1:
+            queries.append('zq%ixv' % rnd.randint(0, 9999))
+            continue
+        _, symbol = rnd.choice(project.symbols)
+        length = rnd.randint(2, min(10, len(symbol)))
+        start = rnd.randint(0, len(symbol) - length)
+        queries.append(symbol[start:start + length])
+    return queries
+
+
+def run(args):
+    rnd = random.Random(args.seed)
+    work_path = args.work_path or tempfile.mkdtemp(prefix='importmagic-bench')
+    project_path = os.path.join(work_path, 'project')
+    temp_path = os.path.join(work_path, 'index')
+    cache_path = os.path.join(work_path, 'cache')
+
+    started = time.perf_counter()
+    project = SyntheticProject(
+        project_path, args.packages, args.modules, args.depth,
+        args.branching, args.symbols, args.seed)
+    report = dict(
+        revision=get_revision(),
+        python=platform.python_version(),
+        platform=platform.platform(),
+        cpu_count=os.cpu_count(),
+        arguments=vars(args),
+        project=dict(
+            files=len(project.files), symbols=len(project.symbols),
+            generate_s=round(time.perf_counter() - started, 2)))
+
+    paths = [project_path]
+    if args.site_packages:
+        paths.append(args.site_packages)
+    config = dict(
+        paths=paths, workspacePath=project_path, workspaceName='benchmark',
+        tempPath=temp_path, cachePath=cache_path)
+    config.update(json.loads(args.config))
+
+    results = report['results'] = {}
+    peak_rss = []
+    try:
+        # Cold start. The index is built in the background after configure
+        # and queued requests are answered after it
+        client = DaemonClient(args.python)
+        try:
+            _, elapsed = client.request('configure', **config)
+            results['configure_cold'] = dict(
+                latency_ms=round(elapsed * 1000, 3),
+                since_spawn_s=round(
+                    time.perf_counter() - client.started, 3))
+            response, elapsed = client.request('changeFiles', files=[])
+            results['build_cold'] = dict(
+                wall_s=round(time.perf_counter() - client.started, 3),
+                documents=response.get('docs_count'))
+
+            if args.rebuild:
+                response, elapsed = client.request('rebuildIndex')
+                results['rebuildIndex'] = dict(
+                    wall_s=round(elapsed, 3),
+                    documents=response.get('docs_count'))
+            # Let the snapshot and the other background tasks finish
+            client.request('changeFiles', files=[])
+            peak_rss.append(client.peak_rss())
+        finally:
+            client.close()
+        report['index_size_mb'] = get_size(temp_path)
+        report['cache_size_mb'] = get_size(cache_path)
+
+        # Warm start: requests the editor sends while it's used
+        client = DaemonClient(args.python)
+        try:
+            _, elapsed = client.request('configure', **config)
+            results['configure_warm'] = dict(
+                latency_ms=round(elapsed * 1000, 3),
+                since_spawn_s=round(
+                    time.perf_counter() - client.started, 3))
+            client.request('changeFiles', files=[])
+
+            latencies = []
+            for text in get_queries(project, args.queries, rnd):
+                _, elapsed = client.request('getSymbols', text=text)
+                latencies.append(elapsed)
+            results['getSymbols'] = summarize(latencies)
+
+            latencies = []
+            for _ in range(args.requests):
+                filename = rnd.choice(project.files)
+                with open(filename) as f:
+                    source = f.read()
+                _, symbol = rnd.choice(project.symbols)
+                _, elapsed = client.request(
+                    'importSuggestions', sourceFile=filename,
+                    sourceText=source + '\n%s()\n' % symbol,
+                    unresolvedName=symbol)
+                latencies.append(elapsed)
+            results['importSuggestions'] = summarize(latencies)
+
+            latencies = []
+            for _ in range(args.requests):
+                filename = rnd.choice(project.files)
+                module, symbol = rnd.choice(project.symbols)
+                with open(filename) as f:
+                    source = f.read()
+                _, elapsed = client.request(
+                    'insertImport', sourceFile=filename, sourceText=source,
+                    module=module, symbol=symbol)
+                latencies.append(elapsed)
+            results['insertImport'] = summarize(latencies)
+
+            latencies = []
+            for i in range(args.changes):
+                filename = rnd.choice(project.files)
+                with open(filename, 'a') as f:
+                    f.write('\ndef changed_symbol_%i():\n    pass\n' % i)
+                _, elapsed = client.request('changeFiles', files=[filename])
+                latencies.append(elapsed)
+            results['changeFiles'] = summarize(latencies)
+            peak_rss.append(client.peak_rss())
+        finally:
+            client.close()
+    finally:
+        if not args.keep and not args.work_path:
+            shutil.rmtree(work_path, ignore_errors=True)
+
+    peak_rss = [value for value in peak_rss if value is not None]
+    report['peak_rss_mb'] = max(peak_rss) if peak_rss else None
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark of indexing, search and import insertion')
+    parser.add_argument('--packages', type=int, default=20,
+                        help='Top-level packages of the synthetic project')
+    parser.add_argument('--modules', type=int, default=20,
+                        help='Modules in every package')
+    parser.add_argument('--depth', type=int, default=2,
+                        help='Levels of subpackages')
+    parser.add_argument('--branching', type=int, default=2,
+                        help='Subpackages in every package')
+    parser.add_argument('--symbols', type=int, default=30,
+                        help='Symbols in every module')
+    parser.add_argument('--site-packages',
+                        help='Real directory which is indexed too')
+    parser.add_argument('--config', default='{}',
+                        help='JSON with extra configure() arguments')
+    parser.add_argument('--queries', type=int, default=200,
+                        help='getSymbols requests')
+    parser.add_argument('--requests', type=int, default=50,
+                        help='importSuggestions and insertImport requests')
+    parser.add_argument('--changes', type=int, default=20,
+                        help='changeFiles requests')
+    parser.add_argument('--no-rebuild', dest='rebuild', action='store_false',
+                        help="Don't measure rebuildIndex of a warm index")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--python', default=sys.executable,
+                        help='Interpreter which runs the daemon')
+    parser.add_argument('--work-path',
+                        help='New directory for the project and the '
+                             "index. It's kept")
+    parser.add_argument('--keep', action='store_true',
+                        help="Don't remove the temporary directory")
+    parser.add_argument('--output', help='JSON file. By-default stdout')
+    args = parser.parse_args()
+
+    report = run(args)
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Checks that the index doesn't depend on the number of indexer workers.
+Roots with modules of the same name are generated, they're indexed with
+one worker and with several ones and the documents are compared.
+
+    python scripts/check_index.py
+    python scripts/check_index.py --workers 4 --root /usr/lib/python3
+
+Exits with 1 and prints the different documents when they aren't equal.
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DAEMON_PATH = os.path.join(ROOT, 'pythonFiles')
+
+# Same files in the first and the second root, the first ones win
+OVERLAPPING_FILES = {
+    'first/dup/__init__.py': 'def alpha():\n    pass\n',
+    'first/single.py': 'ONE = 1\n',
+    'first/other.txt': 'Not a module\n',
+    'second/dup/__init__.py': 'def beta():\n    pass\n',
+    'second/dup/extra.py': 'def extra():\n    pass\n',
+    'second/single.py': 'TWO = 2\n',
+    'second/other/__init__.py': 'OTHER = 1\n',
+}
+
+
+def write_roots(directory):
+    for name, text in OVERLAPPING_FILES.items():
+        filename = os.path.join(directory, name)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, 'w') as f:
+            f.write(text)
+    return [os.path.join(directory, 'first'),
+            os.path.join(directory, 'second')]
+
+
+def get_documents(paths, workers):
+    from src.indexer import DirIndexer
+
+    # Like the environment index, aliased stdlib modules need builtins
+    documents = []
+    idx = DirIndexer(paths, True, workers, builtins=True)
+    idx.build(None, documents.extend)
+    return sorted((d['filename'], d['module'], d['symbol'], d['kind'],
+                   d['score']) for d in documents)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--workers', type=int, default=2,
+                        help='Workers which are compared with one')
+    parser.add_argument('--root', action='append', default=[],
+                        help='Roots which are indexed after the generated '
+                             'ones, e.g. site-packages')
+    args = parser.parse_args()
+
+    # The same modules which the daemon uses
+    sys.path.insert(0, DAEMON_PATH)
+    for lib in ('isort', os.path.join('whoosh', 'src'), 'importmagic'):
+        sys.path.insert(0, os.path.join(DAEMON_PATH, 'libs', lib))
+
+    directory = tempfile.mkdtemp(prefix='importmagic-check-')
+    try:
+        paths = write_roots(directory) + args.root
+        single = get_documents(paths, 1)
+        several = get_documents(paths, args.workers)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    if single == several:
+        print('%i documents are equal' % len(single))
+        return 0
+    for document in sorted(set(single) ^ set(several)):
+        print('%i worker(s): %r' % (
+            1 if document in single else args.workers, document))
+    return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
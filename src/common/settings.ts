@@ -19,6 +19,11 @@ export class Settings implements ISettings, vscode.Disposable {
     private maxColumns: number = null;
     private indentWithTabs: boolean = null;
     public skipTestFolders: boolean = true;
+    public indexWorkers: number = 1;
+    public indexWriter: object = {};
+    public searchBackend: string = 'whoosh';
+    public fuzzyMatching: boolean = false;
+    public serverMode: boolean = false;
 
     private workspaceRoot: vscode.Uri;
     private disposables: vscode.Disposable[] = [];
@@ -64,6 +69,11 @@ export class Settings implements ISettings, vscode.Disposable {
         this.maxColumns = pluginSettings.get('maxColumns');
         this.indentWithTabs = pluginSettings.get('indentWithTabs');
         this.skipTestFolders = pluginSettings.get('skipTestFolders');
+        this.indexWorkers = pluginSettings.get('indexWorkers', 1);
+        this.indexWriter = pluginSettings.get('indexWriter', {});
+        this.searchBackend = pluginSettings.get('searchBackend', 'whoosh');
+        this.fuzzyMatching = pluginSettings.get('fuzzyMatching', false);
+        this.serverMode = pluginSettings.get('serverMode', false);
 
         if (!this.maxColumns) {
             const rulers = editorSettings.get<number[]>('rulers', []);
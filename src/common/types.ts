@@ -51,6 +51,11 @@ export interface ISettings {
     extraPaths: string[];
     style: IStyle;
     skipTestFolders: boolean;
+    indexWorkers: number;
+    indexWriter: object;
+    searchBackend: string;
+    fuzzyMatching: boolean;
+    serverMode: boolean;
 }
 
 /**
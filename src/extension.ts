@@ -8,7 +8,8 @@ import { ContextProvider } from './providers/contextProvider';
 const PYTHON: vscode.DocumentSelector = { scheme: 'file', language: 'python' };
 
 export function activate(context: vscode.ExtensionContext) {
-    const importMagicFactory = new ImportMagicFactory(context.asAbsolutePath('.'), context.storagePath);
+    const importMagicFactory = new ImportMagicFactory(context.asAbsolutePath('.'), context.storagePath,
+        context.globalStoragePath);
 
     // Two providers
     const completionProvider = vscode.languages.registerCompletionItemProvider(PYTHON,
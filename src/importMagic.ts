@@ -1,9 +1,12 @@
 import { FileSystemWatcher } from './common/fsWatcher';
-import { Settings } from './common/settings';
+import { IS_WINDOWS, Settings } from './common/settings';
 import { ProcessService } from './common/proc';
+import * as crypto from 'crypto';
+import * as net from 'net';
+import * as os from 'os';
 import * as path from 'path';
 import * as vscode from 'vscode';
-import { ChildProcess } from 'child_process';
+import { ChildProcess, spawn } from 'child_process';
 import { createDeferred, Deferred } from './common/helpers';
 import { Progress } from './common/progress';
 import { Logger } from './common/logger';
@@ -28,7 +31,8 @@ export enum ActionType {
     Renew = 'rebuildIndex',  // Renew index
     Suggestions = 'importSuggestions',
     Import = 'insertImport',
-    Symbols = 'getSymbols'
+    Symbols = 'getSymbols',
+    Cancel = 'cancel'
 }
 
 export interface ICommandResult {
@@ -55,6 +59,14 @@ export interface ISuggestionSymbol {
 
 export interface IResultSymbols extends ICommandResult {
     items: ISuggestionSymbol[];
+    hasMore?: boolean;
+}
+
+// Columnar results: module is an index in the list of distinct modules
+interface ISymbolColumns {
+    symbol: string[];
+    module: number[];
+    kind: string;
 }
 
 export interface IResultImport extends ICommandResult {
@@ -79,9 +91,15 @@ interface ICommandConfigure<T extends ICommandResult> extends ICommand<T> {
     paths: string[];
     workspacePath: string;
     skipTest: boolean;
+    indexWorkers: number;
+    indexWriter: object;
+    searchBackend: string;
+    fuzzyMatching: boolean;
     style: object;
     tempPath: string;
+    cachePath: string;
     workspaceName: string;
+    protocol: object;
 }
 
 interface ICommandChangeFiles<T extends ICommandResult> extends ICommand<T> {
@@ -92,15 +110,25 @@ export interface ICommandRenew<T extends ICommandResult> extends ICommand<T> { }
 
 export interface ICommandSuggestions<T extends ICommandResult> extends ICommand<T> {
     sourceFile: string;
+    sourceText?: string;  // Editor buffer, otherwise sourceFile is read
     unresolvedName: string;
+    limit?: number;
+    offset?: number;
 }
 
 export interface ICommandSymbols<T extends ICommandResult> extends ICommand<T> {
     text: string;
+    limit?: number;
+    offset?: number;
+}
+
+interface ICommandCancel<T extends ICommandResult> extends ICommand<T> {
+    cancelId: number;
 }
 
 export interface ICommandImport<T extends ICommandResult> extends ICommand<T> {
     sourceFile: string;
+    sourceText?: string;
     module: string;
     // location: string;
     symbol?: string;
@@ -111,7 +139,10 @@ export class ImportMagic implements vscode.Disposable {
     public settings: Settings;
 
     private proc: ChildProcess;
+    private socket: net.Socket;  // Connection to the shared server
     private previousData = '';
+    private previousErrors = '';
+    private framed = false;  // Length-prefixed responses after configure
 
     private processDeferred: Deferred<void>;
     private commands = new Map<number, ICommand<ICommandResult>>();
@@ -120,7 +151,8 @@ export class ImportMagic implements vscode.Disposable {
     private stopReason: string = '';  // Bad startup configuration reason
 
     constructor(private extensionRootDir: string, private workspacePath: string,
-            private storagePath: string, private workspaceName: string,
+            private storagePath: string, private globalStoragePath: string,
+            private workspaceName: string,
             private progress: Progress, private readonly logger: Logger) {
         this.settings = new Settings(workspacePath, this.onChangeSettings.bind(this)); //  .getInstance(vscode.Uri.file(this.workspacePath));
         this.disposables.push(this.settings)
@@ -136,28 +168,52 @@ export class ImportMagic implements vscode.Disposable {
         return <T>o[name];
     }
 
+    static connect(socketPath: string): Promise<net.Socket> {
+        return new Promise(resolve => {
+            const socket = net.createConnection(socketPath);
+            socket.once('connect', () => resolve(socket));
+            socket.once('error', () => resolve(null));
+        });
+    }
+
+    static isIndexingAction(action: ActionType): boolean {
+        return action === ActionType.Configure || action === ActionType.ChangeFiles ||
+            action === ActionType.Renew;
+    }
+
     public dispose() {
         this.disposables.forEach(disposable => disposable.dispose());
         this.disposables = [];
         this.killProcess();
     }
 
-    public async sendCommand<T extends ICommandResult>(cmd: ICommand<T>): Promise<T> {
+    public async sendCommand<T extends ICommandResult>(cmd: ICommand<T>,
+            token?: vscode.CancellationToken): Promise<T> {
         await this.processDeferred.promise;
         if (this.stopReason) {
             throw new Error(`Extenstion is not ready: ${this.stopReason}`)
         }
 
-        // Await commands from queue
-        while (this.commands.size > 0) {
-            const firstCmd: ICommand<ICommandResult> = this.commands.values().next().value;
-            if (firstCmd === undefined) {
-                break;
-            }
-            await firstCmd.deferred.promise;
+        // Indexing runs in the background on the server side, so we don't
+        // wait for the previous commands. Responses are matched by id
+        const promise = this.sendRequest(cmd);
+        if (token) {
+            // Queued request will be answered as cancelled
+            const disposable = token.onCancellationRequested(() => this.cancelRequest(cmd.commandId));
+            promise.then(() => disposable.dispose(), () => disposable.dispose());
         }
+        return promise;
+    }
 
-        return this.sendRequest(cmd);
+    private cancelRequest(commandId: number) {
+        if (!this.commands.has(commandId)) {
+            return;
+        }
+        const cmd: ICommandCancel<ICommandResult> = {
+            action: ActionType.Cancel,
+            cancelId: commandId
+        };
+        this.sendRequest(cmd).catch(() => undefined);
     }
 
     public async configure() {
@@ -166,9 +222,15 @@ export class ImportMagic implements vscode.Disposable {
             paths: this.settings.extraPaths,
             workspacePath: this.workspacePath,
             skipTest: this.settings.skipTestFolders,
+            indexWorkers: this.settings.indexWorkers,
+            indexWriter: this.settings.indexWriter,
+            searchBackend: this.settings.searchBackend,
+            fuzzyMatching: this.settings.fuzzyMatching,
             tempPath: this.storagePath,
+            cachePath: this.globalStoragePath ? path.join(this.globalStoragePath, 'cache') : undefined,
             workspaceName: this.workspaceName,
-            style: this.settings.style
+            style: this.settings.style,
+            protocol: { framing: 'length', columnar: true }
         };
 
         // If configure was with error, then we will stop language server
@@ -199,11 +261,27 @@ export class ImportMagic implements vscode.Disposable {
         this.processDeferred = createDeferred<void>();
         this.killProcess();
         this.clearPendingRequests();
+        this.previousData = '';
+        this.previousErrors = '';
+        this.framed = false;
         this.spawnProcess();
     }
 
     private async spawnProcess() {
         this.restartAttempts += 1;
+        const started = this.settings.serverMode && !IS_WINDOWS ?
+            await this.connectServer() : this.startProcess();
+        if (!started) {
+            this.processDeferred.reject();
+            vscode.window.showErrorMessage(`${this.stopReason}`);
+            return false;
+        }
+
+        await this.configure();
+        this.processDeferred.resolve();
+    }
+
+    private startProcess(): boolean {
         const cwd: string = path.join(this.extensionRootDir, 'pythonFiles');
         const pythonProcess = new ProcessService();
 
@@ -213,9 +291,7 @@ export class ImportMagic implements vscode.Disposable {
         this.proc = result.proc;
 
         if (!result.proc.pid) {
-            this.processDeferred.reject();
             this.stopReason = 'Python interpreter is not found';
-            vscode.window.showErrorMessage(`${this.stopReason}`);
             return false;
         }
 
@@ -236,18 +312,94 @@ export class ImportMagic implements vscode.Disposable {
             this.logger.logError(this.workspaceName, `${error}`);
         });
         result.out.subscribe(output => {
-            const data = output.out;
-            const dataStr = this.previousData = `${this.previousData}${data}`;
+            if (output.source === 'stderr') {
+                this.onErrorOutput(output.out);
+            } else {
+                this.onOutput(output.out);
+            }
+        });
+        return true;
+    }
 
-            if (dataStr.endsWith('\n')) {
-                this.previousData = '';
+    private getSocketPath(): string {
+        // One server per interpreter, extension version and user
+        const key = `${this.settings.pythonPath}:${this.extensionRootDir}:${os.userInfo().uid}`;
+        const hash = crypto.createHash('md5').update(key).digest('hex').slice(0, 12);
+        return path.join(os.tmpdir(), `importmagic-${hash}.sock`);
+    }
 
-                dataStr.split('\n').forEach(lineStr => this.onData(lineStr));
+    private async connectServer(): Promise<boolean> {
+        const socketPath = this.getSocketPath();
+        let socket = await ImportMagic.connect(socketPath);
+        if (!socket) {
+            // The first window starts it. It outlives the windows and exits
+            // when nobody has used it for a while
+            const cwd: string = path.join(this.extensionRootDir, 'pythonFiles');
+            const args = ['-W', 'ignore', '-OO', 'importMagic.py', '--server', socketPath];
+            const server = spawn(this.settings.pythonPath, args, { cwd, detached: true, stdio: 'ignore' });
+            server.on('error', error => {
+                this.logger.logError(this.workspaceName, `${error}`);
+            });
+            server.unref();
+            for (let attempt = 0; !socket && attempt < 50; attempt++) {
+                await new Promise(resolve => setTimeout(resolve, 200));
+                socket = await ImportMagic.connect(socketPath);
             }
+        }
+        if (!socket) {
+            this.stopReason = 'ImportMagic server is not started. See vscode-importmagic logs';
+            return false;
+        }
+
+        this.socket = socket;
+        socket.setEncoding('utf8');
+        socket.on('data', (data: string) => this.onOutput(data));
+        socket.on('close', () => {
+            this.logger.log(this.workspaceName, 'connectServer.close');
+            if (this.socket !== socket) {
+                return;  // Closed by killProcess()
+            }
+            this.socket = null;
+            this.stopReason = 'Something went wrong. See vscode-importmagic logs';
+            vscode.window.showErrorMessage(`${this.workspaceName}: ${this.stopReason}`);
         });
+        return true;
+    }
 
-        await this.configure();
-        this.processDeferred.resolve();
+    private onOutput(data: string) {
+        // Lines until the configure response, then "<length>:<json>" frames
+        // if they were negotiated. JSON is ASCII, so the length is in chars
+        this.previousData = `${this.previousData}${data}`;
+        while (true) {
+            let message: string;
+            if (this.framed) {
+                const separator = this.previousData.indexOf(':');
+                if (separator < 0) {
+                    break;
+                }
+                const end = separator + 1 + parseInt(this.previousData.slice(0, separator), 10);
+                if (this.previousData.length < end) {
+                    break;
+                }
+                message = this.previousData.slice(separator + 1, end);
+                this.previousData = this.previousData.slice(end);
+            } else {
+                const end = this.previousData.indexOf('\n');
+                if (end < 0) {
+                    break;
+                }
+                message = this.previousData.slice(0, end);
+                this.previousData = this.previousData.slice(end + 1);
+            }
+            this.onData(message);
+        }
+    }
+
+    private onErrorOutput(data: string) {
+        // Errors of the stdio daemon are always lines
+        const lines = `${this.previousErrors}${data}`.split('\n');
+        this.previousErrors = lines.pop();
+        lines.forEach(lineStr => this.onData(lineStr));
     }
 
     private killProcess() {
@@ -255,9 +407,16 @@ export class ImportMagic implements vscode.Disposable {
             if (this.proc) {
                 this.proc.kill();
             }
+            if (this.socket) {
+                // The server keeps working for the other windows
+                const socket = this.socket;
+                this.socket = null;
+                socket.destroy();
+            }
         // tslint:disable-next-line:no-empty
         } catch { }
         this.proc = null;
+        this.socket = null;
     }
 
     private sendRequest<T extends ICommandResult>(cmd: ICommand<T>): Promise<T> {
@@ -273,12 +432,13 @@ export class ImportMagic implements vscode.Disposable {
         executionCmd.commandId = this.commandId;
 
         try {
-            if (!this.proc) {
+            if (!this.proc && !this.socket) {
                 throw new Error('ImportMagic process is die');
             }
 
             this.logger.log(this.workspaceName, `cmd -> ${JSON.stringify(extendedPayload)}`);
-            this.proc.stdin.write(`${JSON.stringify(extendedPayload)}\n`);
+            const input = this.socket || this.proc.stdin;
+            input.write(`${JSON.stringify(extendedPayload)}\n`);
             this.commands.set(this.commandId, executionCmd);
         }catch (ex) {
             this.logger.logError(this.workspaceName, ex.message);
@@ -309,13 +469,16 @@ export class ImportMagic implements vscode.Disposable {
             const progressMessage = ImportMagic.getProperty<string>(response, 'progress');
             const isError: boolean = !!response.error;
 
+            const protocol = ImportMagic.getProperty<object>(response, 'protocol');
+            if (protocol) {
+                // The next messages are in the negotiated format
+                this.framed = ImportMagic.getProperty<string>(protocol, 'framing') === 'length';
+            }
+
             if (progressMessage) {
                 // Only set progress
                 this.progress.setTitle(progressMessage);
                 return;
-            } else {
-                // Hide progress and parse the answer
-                this.progress.hide();
             }
 
             // Somethimes error may happened just after startup
@@ -323,12 +486,17 @@ export class ImportMagic implements vscode.Disposable {
                 this.logger.logError(this.workspaceName, response.message);
             }
 
+            const cmd = responseId === undefined ? undefined : this.commands.get(responseId);
+            if (!cmd || ImportMagic.isIndexingAction(cmd.action)) {
+                // Searches may be answered while indexing is in progress
+                this.progress.hide();
+            }
+
             if (responseId === undefined) {
                 this.logger.logError(this.workspaceName, 'Response is not contain id');
                 return;
             }
 
-            const cmd = this.commands.get(responseId);
             if (!cmd) {
                 return;
             }
@@ -367,6 +535,8 @@ export class ImportMagic implements vscode.Disposable {
                 return this.onSymbols;
             case ActionType.Import:
                 return this.onImport;
+            case ActionType.Cancel:
+                return this.onCancel;
             default:
                 return;
         }
@@ -410,11 +580,28 @@ export class ImportMagic implements vscode.Disposable {
         };
     }
 
+    private onCancel(command: ICommand<ICommandResult>, response: object): ICommandResult {
+        return {
+            requestId: command.commandId
+        };
+    }
+
     private onSymbols(command: ICommand<ICommandResult>, response: object): IResultSymbols {
-        const items = ImportMagic.getProperty<ISuggestionSymbol[]>(response, 'items');
+        // Cancelled or superseded requests come without items
+        let items = ImportMagic.getProperty<ISuggestionSymbol[]>(response, 'items') || [];
+        const columns = ImportMagic.getProperty<ISymbolColumns>(response, 'columns');
+        if (columns) {
+            const modules = ImportMagic.getProperty<string[]>(response, 'modules');
+            items = columns.symbol.map((symbol, i) => ({
+                symbol,
+                module: modules[columns.module[i]],
+                kind: columns.kind[i]
+            }));
+        }
         return {
             requestId: command.commandId,
-            items
+            items,
+            hasMore: !!ImportMagic.getProperty<boolean>(response, 'has_more')
         };
     }
 }
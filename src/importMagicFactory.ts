@@ -11,7 +11,8 @@ export class ImportMagicFactory implements Disposable {
     private progress: Progress = new Progress();
     private readonly logger: Logger = new Logger();
 
-    constructor(private extensionRootPath: string, private storagePath: string) {
+    constructor(private extensionRootPath: string, private storagePath: string,
+            private globalStoragePath: string) {
         this.disposables = [];
         this.proxyHandlers = new Map<string, ImportMagic>();
         this.logger.log('', 'Starting vscode-importmagic...');
@@ -35,7 +36,8 @@ export class ImportMagicFactory implements Disposable {
         if (!importMagic) {
             importMagic = new ImportMagic(
                 this.extensionRootPath, workspacePath, 
-                this.storagePath, workspaceName, this.progress, this.logger);
+                this.storagePath, this.globalStoragePath, workspaceName,
+                this.progress, this.logger);
             this.disposables.push(importMagic);
             this.proxyHandlers.set(workspacePath, importMagic);
         }
@@ -33,9 +33,13 @@ export class CompletionProvider implements vscode.CompletionItemProvider {
 
         const cmd: ICommandSymbols<IResultSymbols> = {
             action: ActionType.Symbols,
-            text
+            text,
+            limit: 50
         };
-        const result = await importMagic.sendCommand(cmd);
+        const result = await importMagic.sendCommand(cmd, token);
+        if (token.isCancellationRequested) {
+            return undefined;
+        }
 
         return result.items.map(item => this.toVsCodeCompletion(document, position, item));
     }
@@ -1,8 +1,7 @@
-import * as fs from 'fs-extra';
 import {commands, Disposable, Position, QuickPickItem, QuickPickOptions, Range, TextDocument, window, workspace, CancellationTokenSource, WorkspaceEdit, Uri} from 'vscode';
 import { ActionType, ICommandSuggestions, ICommandImport, IResultImport, IResultSymbols, ISuggestionSymbol, IDiffCommand, DiffAction, ICommandRenew, IResultRenew } from '../importMagic';
 import { ImportMagicFactory } from '../importMagicFactory';
-import { getTempFileWithDocumentContents, isTestExecution } from '../common/utils';
+import { isTestExecution } from '../common/utils';
 
 
 interface ImportPathQuickPickItem extends QuickPickItem {
@@ -30,7 +29,7 @@ export class ContextProvider implements Disposable {
         this.disposables = [];
     }
 
-    public async getImportSuggestions(sourceFile: string, unresolvedName: string): Promise<ImportPathQuickPickItem[]> {
+    public async getImportSuggestions(sourceFile: string, sourceText: string, unresolvedName: string): Promise<ImportPathQuickPickItem[]> {
         const activeEditor = window.activeTextEditor;
         if (!activeEditor) {
             return [];
@@ -44,7 +43,9 @@ export class ContextProvider implements Disposable {
         const cmd: ICommandSuggestions<IResultSymbols> = {
             action: ActionType.Suggestions,
             sourceFile,
-            unresolvedName
+            sourceText,
+            unresolvedName,
+            limit: 50
         };
 
         try{
@@ -91,8 +92,6 @@ export class ContextProvider implements Disposable {
             return undefined;
         }
 
-        const tmpFileCreated = document.isDirty;
-        const filePath = tmpFileCreated ? await getTempFileWithDocumentContents(document) : document.fileName;
         const cToken: CancellationTokenSource = new CancellationTokenSource();
 
         try {
@@ -102,7 +101,8 @@ export class ContextProvider implements Disposable {
                 placeHolder: `Import statement for ${unresolvedName}`
             };
 
-            const suggestions = this.getImportSuggestions(filePath, unresolvedName);
+            // Unsaved changes are sent as is, so the file isn't read from disk
+            const suggestions = this.getImportSuggestions(document.fileName, document.getText(), unresolvedName);
             suggestions.then((results: ImportPathQuickPickItem[]) => {
                 if (results.length === 0) {
                     window.showWarningMessage('Importmagic: Nothing to import');
@@ -118,9 +118,6 @@ export class ContextProvider implements Disposable {
             }
         } finally {
             cToken.dispose();
-            if (tmpFileCreated) {
-                fs.unlinkSync(filePath);
-            }
         }
     }
 
@@ -142,13 +139,11 @@ export class ContextProvider implements Disposable {
             return undefined;
         }
 
-        const tmpFileCreated = document.isDirty;
-        const filePath = tmpFileCreated ? await getTempFileWithDocumentContents(document) : document.fileName;
-
         try {
             const cmd: ICommandImport<IResultImport> = {
                 action: ActionType.Import,
-                sourceFile: filePath,
+                sourceFile: document.fileName,
+                sourceText: document.getText(),
                 module,
                 symbol
             };
@@ -157,10 +152,6 @@ export class ContextProvider implements Disposable {
             await this.updateSource(document.uri, result);
         } catch (e) {
             window.showErrorMessage(`${e.message}`);
-        } finally {
-            if (tmpFileCreated) {
-                fs.unlinkSync(filePath);
-            }
         }
     }
 